@@ -0,0 +1,44 @@
+import numpy as np
+
+
+class BatchGatherer(object):
+  """
+  Gathers minibatches X[idx], y[idx] into a ring of preallocated buffers
+  with np.take(..., out=...), so a training loop does not allocate new arrays
+  (and fault in fresh pages) on every iteration.
+
+  The batch returned by gather() lives in one of num_buffers slots and is
+  overwritten num_buffers calls later, so callers must be done with it (or
+  copy it) by then. Slices are returned as views, and data that is not an
+  ndarray (such as a LazyImageArray) is indexed normally.
+  """
+
+  def __init__(self, X, y, num_buffers=1):
+    self.X = X
+    self.y = y
+    self.num_buffers = num_buffers
+    self._buffers = [None] * num_buffers
+    self._next = 0
+
+  def gather(self, idx):
+    if isinstance(idx, slice) or not isinstance(self.X, np.ndarray):
+      return self.X[idx], self.y[idx]
+    idx = np.asarray(idx)
+    if idx.size and (idx.min() < 0 or idx.max() >= len(self.X)):
+      # negative indices, or ones that should raise IndexError
+      return self.X[idx], self.y[idx]
+    slot = self._next
+    self._next = (slot + 1) % self.num_buffers
+    buffers = self._buffers[slot]
+    if buffers is None or buffers[1].shape != idx.shape:
+      X_shape = idx.shape + self.X.shape[1:]
+      buffers = (np.empty(X_shape, dtype=self.X.dtype),
+                 np.empty(idx.shape, dtype=self.y.dtype))
+      self._buffers[slot] = buffers
+    X_buf, y_buf = buffers
+    # np.take always buffers its output when mode='raise'; the indices were
+    # checked to be in range above, so 'clip' is safe and lets it write
+    # straight into out.
+    np.take(self.X, idx, axis=0, out=X_buf, mode='clip')
+    np.take(self.y, idx, axis=0, out=y_buf, mode='clip')
+    return X_buf, y_buf
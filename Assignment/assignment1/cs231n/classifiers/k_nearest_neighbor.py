@@ -1,14 +1,43 @@
+from __future__ import print_function
+import multiprocessing
 import numpy as np
+import time
 from past.builtins import xrange
+from scipy.spatial.distance import cdist
+
+from cs231n.sharedmem import shared_copy, shared_view
+from cs231n.workspace import workspace_array
 
 
 class KNearestNeighbor(object):
-  """ a kNN classifier with L2 distance """
+  """ a kNN classifier with L2, L1 or cosine distance """
 
-  def __init__(self):
-    pass
+  def __init__(self, memory_budget=2 ** 28, dtype=np.float64, metric='l2'):
+    """
+    Inputs:
+    - memory_budget: Approximate number of bytes of scratch memory that
+      kneighbors may use for one tile of distances. Queries and training
+      points are processed in tiles small enough to fit.
+    - dtype: Floating point type the distances of compute_distances_no_loops
+      and kneighbors are computed in. np.float32 halves the memory traffic
+      and roughly doubles the speed of the matrix products, at the cost of
+      precision.
+    - metric: The distance used by kneighbors and predict; either the name
+      of a metric in METRICS ('l2', 'l1' or 'cosine') or a metric object
+      (see L2Metric). Compressed storage, indices and predict with num_loops
+      only support 'l2'.
+    """
+    if isinstance(metric, str):
+      if metric not in METRICS:
+        raise ValueError('Invalid metric "%s"' % metric)
+      metric = METRICS[metric]()
+    self.memory_budget = memory_budget
+    self.dtype = dtype
+    self.metric = metric
+    self._pool = None
 
-  def train(self, X, y):
+  def train(self, X, y, index=None, num_lists=None, storage=None,
+            pca_dim=None, rerank=0):
     """
     Train the classifier. For k-nearest neighbors this is just 
     memorizing the training data.
@@ -18,11 +47,101 @@ class KNearestNeighbor(object):
       consisting of num_train samples each of dimension D.
     - y: A numpy array of shape (N,) containing the training labels, where
          y[i] is the label for X[i].
+      The squared norms of X are computed here and cached, so X should not
+      be modified in place afterwards.
+    - index: Optionally build an index for approximate search with
+      kneighbors / predict(index=...). The only index is 'ivf', an IVFIndex.
+    - num_lists: Number of k-means clusters of the 'ivf' index; defaults to
+      about sqrt(num_train).
+    - storage: How kneighbors stores the training set for its exact search:
+      None to use X as given, or 'float16', 'int8' or 'pca' to search a
+      compressed copy, a CompressedGallery. The compressed copy is 4x
+      ('float16'), 8x ('int8') or D / pca_dim * 2 ('pca') smaller than
+      float64 data and its distances are computed in float32, but they are
+      approximate.
+    - pca_dim: Number of principal components kept by the 'pca' storage.
+    - rerank: With a compressed storage, kneighbors finds the max(k, rerank)
+      nearest points in the compressed space and then re-ranks them by their
+      exact distance to X, which is only read for those candidates (so X
+      can be a memory map). 0 returns the compressed-space neighbors and
+      distances as they are.
     """
+    self.stop_serving()
     self.X_train = X
     self.y_train = y
+    self._train_sq = None
+    self._buffers = None
+    # cache the squared norms ||x||^2 of the training points for the
+    # distance computations
+    self._train_norms()
+    self.index = None
+    self.gallery = None
+    self.rerank = rerank
+    if (storage is not None or index is not None) and not self._is_l2():
+      raise ValueError('Compressed storage and indices need the L2 metric')
+    if storage is not None:
+      self.gallery = CompressedGallery(X, storage, pca_dim)
+    if index == 'ivf':
+      if num_lists is None:
+        num_lists = int(round(np.sqrt(X.shape[0])))
+      self.index = IVFIndex(X, num_lists, memory_budget=self.memory_budget)
+    elif index is not None:
+      raise ValueError('Invalid index "%s"' % index)
     
-  def predict(self, X, k=1, num_loops=0):
+  def add(self, X, y):
+    """
+    Add labeled points to the training set, as if train had been called with
+    the old and new points stacked.
+
+    The first call copies the training set into buffers with spare
+    capacity; later calls append to them in place, doubling the capacity
+    whenever it runs out, so adding N points in total costs O(N) copying
+    rather than O(N) per call. self.X_train and self.y_train are views of
+    the filled part of the buffers, and the squared norms used by
+    kneighbors are computed for the new points only.
+
+    Serving workers (see start_serving) are stopped, since their copy of the
+    training set would be stale. Points can't be added to a compressed
+    storage or an index; train again instead.
+
+    Inputs:
+    - X: A numpy array of shape (num_new, D) containing the new points.
+    - y: A numpy array of shape (num_new,) containing their labels.
+    """
+    if getattr(self, 'gallery', None) is not None or \
+       getattr(self, 'index', None) is not None:
+      raise ValueError('Cannot add points to a compressed storage or index')
+    if getattr(self, 'X_train', None) is None:
+      self.train(X[:0], y[:0])
+    self.stop_serving()
+
+    num_train, num_new = self.X_train.shape[0], X.shape[0]
+    size = num_train + num_new
+    if self._buffers is None or self._buffers[0].shape[0] < size:
+      capacity = max(2 * size, 16)
+      X_buf = np.empty((capacity,) + self.X_train.shape[1:],
+                       dtype=np.result_type(self.X_train, X))
+      y_buf = np.empty(capacity, dtype=np.result_type(self.y_train, y))
+      sq_buf = np.empty(capacity)
+      X_buf[:num_train] = self.X_train
+      y_buf[:num_train] = self.y_train
+      sq_buf[:num_train] = self._train_norms()
+      self._buffers = (X_buf, y_buf, sq_buf)
+    X_buf, y_buf, sq_buf = self._buffers
+    X_buf[num_train:size] = X
+    y_buf[num_train:size] = y
+    sq_buf[num_train:size] = _squared_norms(X_buf[num_train:size])
+    self.X_train = X_buf[:size]
+    self.y_train = y_buf[:size]
+    self._train_sq = sq_buf[:size]
+
+  def _train_norms(self):
+    """ squared norms of the training points, computed once and cached """
+    if self._train_sq is None:
+      self._train_sq = _squared_norms(self.X_train)
+    return self._train_sq
+
+  def predict(self, X, k=1, num_loops=None, index=None, nprobe=1):
     """
     Predict labels for test data using this classifier.
 
@@ -31,13 +150,24 @@ class KNearestNeighbor(object):
          of num_test samples each of dimension D.
     - k: The number of nearest neighbors that vote for the predicted labels.
     - num_loops: Determines which implementation to use to compute distances
-      between training points and testing points.
+      between training points and testing points. None (the default) finds
+      the neighbors with kneighbors, which never forms the full distance
+      matrix; 0, 1 and 2 compute it with compute_distances_no_loops,
+      compute_distances_one_loop and compute_distances_two_loops.
+    - index, nprobe: Passed on to kneighbors to use the approximate index
+      built by train; only used when num_loops is None.
 
     Returns:
     - y: A numpy array of shape (num_test,) containing predicted labels for the
       test data, where y[i] is the predicted label for the test point X[i].  
     """
-    if num_loops == 0:
+    if num_loops is None:
+      idx = self.kneighbors(X, k=k, return_distance=False, index=index,
+                            nprobe=nprobe)
+      return self._vote(self.y_train[idx])
+    elif not self._is_l2():
+      raise ValueError('num_loops needs the L2 metric')
+    elif num_loops == 0:
       dists = self.compute_distances_no_loops(X)
     elif num_loops == 1:
       dists = self.compute_distances_one_loop(X)
@@ -48,6 +178,361 @@ class KNearestNeighbor(object):
 
     return self.predict_labels(dists, k=k)
 
+  def predict_stream(self, batches, k=1, index=None, nprobe=1):
+    """
+    Lazily predict labels for a stream of test batches, such as one read
+    from disk chunk by chunk.
+
+    Each batch is searched with kneighbors as it arrives, and the distance
+    tile and neighbor buffers are reused from one batch to the next, so
+    memory use is bounded by the memory budget and the size of the largest
+    batch, however many batches there are.
+
+    Inputs:
+    - batches: An iterable of numpy arrays of shape (batch_size, D), which
+      may differ from batch to batch.
+    - k, index, nprobe: As for predict.
+
+    Yields:
+    - y: A numpy array of shape (batch_size,) with the predicted labels of
+      each batch, in order.
+    """
+    workspace = {}
+    for X in batches:
+      idx = self.kneighbors(np.asarray(X), k=k, return_distance=False,
+                            index=index, nprobe=nprobe, workspace=workspace)
+      yield self._vote(self.y_train[idx])
+
+  def kneighbors(self, X, k=1, return_distance=True, index=None, nprobe=1,
+                 workspace=None):
+    """
+    Find the k nearest training points of each test point without forming
+    the full num_test x num_train distance matrix.
+
+    Distances are computed one tile of test points by training points at a
+    time, with the tile sized to fit in self.memory_budget, and only the
+    running k smallest of each test point are kept, so memory use is
+    O(num_test * k) plus one tile. Tiles are filled by self.metric; for L2
+    they hold squared distances, which rank the same, built in place from a
+    single matrix product, and square roots are only taken of the k
+    distances returned.
+
+    Inputs:
+    - X: A numpy array of shape (num_test, D) containing test data.
+    - k: The number of neighbors to find.
+    - return_distance: Whether to return the distances as well as the indices.
+      With a compressed storage (see train) and no re-ranking, the distances
+      are those between the compressed vectors.
+    - index: None for an exact search, or 'ivf' to search only part of the
+      training set with the IVFIndex built by train(..., index='ivf'). The
+      neighbors found are then approximate but their distances are exact.
+    - nprobe: Number of IVF lists searched per test point; larger values
+      raise the recall of the 'ivf' search and lower its throughput.
+    - workspace: Optional dict in which the exact search keeps its distance
+      tile and output arrays. Passing the same dict to repeated calls reuses
+      the buffers instead of allocating new ones; the arrays returned are
+      then overwritten by the next call.
+
+    Returns a tuple of:
+    - dists: A numpy array of shape (num_test, k) where dists[i, j] is the
+      distance (under self.metric) between the ith test point and its jth
+      nearest training point, in increasing order. Only returned if return_distance
+      is True.
+    - idx: A numpy array of shape (num_test, k) giving the indices into
+      self.X_train of those training points. Equally distant points are
+      ordered by index.
+    """
+    num_test = X.shape[0]
+    num_train = self.X_train.shape[0]
+    if not 1 <= k <= num_train:
+      raise ValueError('Invalid value %d for k' % k)
+    if index is not None:
+      return self._kneighbors_index(X, k, return_distance, index, nprobe)
+    if self._pool is not None:
+      return self._kneighbors_sharded(X, k, return_distance)
+    gallery = self.gallery
+    rerank = gallery is not None and self.rerank > 0
+    num_candidates = k
+    if rerank:
+      num_candidates = min(num_train, max(k, self.rerank))
+
+    # bytes of the float copies made of a training and a test point, if any
+    if gallery is None:
+      train_sq = self._train_norms().astype(self.dtype, copy=False)
+      tile_dtype = self.dtype
+      train_copy = self.X_train.dtype != tile_dtype
+      dim = self.X_train.shape[1]
+    else:
+      train_sq = gallery.sq_norms
+      tile_dtype = np.float32
+      train_copy = gallery.codes.dtype != tile_dtype
+      dim = gallery.codes.shape[1]
+    row_bytes = dim * np.dtype(tile_dtype).itemsize
+    test_block, train_block = self._block_sizes(
+      num_test, num_train, num_candidates, row_bytes if train_copy else 0,
+      row_bytes)
+    tile = workspace_array(workspace, 'tile', test_block * train_block,
+                           tile_dtype)
+    dists = workspace_array(workspace, 'dists', (num_test, k), np.float64)
+    idx = workspace_array(workspace, 'idx', (num_test, k), np.intp)
+    for start in xrange(0, num_test, test_block):
+      if gallery is None:
+        X_block = np.asarray(X[start:start + test_block], dtype=self.dtype)
+      else:
+        X_block = gallery.encode(X[start:start + test_block])
+      test_sq = np.sum(np.square(X_block), axis=1)
+      best_dists, best_idx = None, None
+      for train_start in xrange(0, num_train, train_block):
+        train_stop = min(train_start + train_block, num_train)
+        # a single training block is converted once for all test blocks
+        if start == 0 or train_block < num_train:
+          # drop the previous block before converting the next one
+          X_train_block = None
+          if gallery is None:
+            X_train_block = np.asarray(self.X_train[train_start:train_stop],
+                                       dtype=self.dtype)
+          else:
+            X_train_block = gallery.decode(train_start, train_stop)
+        d = tile[:X_block.shape[0] * X_train_block.shape[0]]
+        d = d.reshape(X_block.shape[0], X_train_block.shape[0])
+        self.metric.tile(X_block, test_sq, X_train_block,
+                         train_sq[train_start:train_stop], d)
+        best_dists, best_idx = _merge_top_k(best_dists, best_idx, d,
+                                            train_start, num_candidates)
+      if rerank:
+        best_dists, best_idx = self._rerank(X[start:start + test_block],
+                                            best_idx, k)
+      # order each row by distance, then by index
+      order = np.lexsort((best_idx, best_dists))
+      rows = np.arange(best_dists.shape[0])[:, np.newaxis]
+      dists[start:start + test_block] = best_dists[rows, order]
+      idx[start:start + test_block] = best_idx[rows, order]
+
+    if not return_distance:
+      return idx
+    return self.metric.finish(dists), idx
+
+  def cross_validate(self, X, y, k_choices, num_folds=5):
+    """
+    Run num_folds-fold cross-validation of the classifier for every value of
+    k in k_choices.
+
+    X and y are split into num_folds contiguous folds as by np.array_split.
+    For each fold, the max(k_choices) nearest neighbors of its points among
+    the other folds are found once with kneighbors; the prediction for each
+    k is then the vote of the first k of them. The cost of a sweep therefore
+    barely grows with the number of k values. The predictions are the same
+    as those of predict after training on the other folds.
+
+    Inputs:
+    - X: A numpy array of shape (N, D) containing the data to split.
+    - y: A numpy array of shape (N,) containing the labels.
+    - k_choices: List of the values of k to evaluate.
+    - num_folds: Number of folds.
+
+    Returns:
+    A dictionary mapping each k in k_choices to a list of length num_folds
+    with the validation accuracy of each fold.
+    """
+    max_k = max(k_choices)
+    folds = np.array_split(np.arange(X.shape[0]), num_folds)
+    k_to_accuracies = dict((k, []) for k in k_choices)
+    knn = KNearestNeighbor(memory_budget=self.memory_budget, dtype=self.dtype,
+                           metric=self.metric)
+    for i, val_idx in enumerate(folds):
+      train_idx = np.concatenate(folds[:i] + folds[i + 1:])
+      knn.train(X[train_idx], y[train_idx])
+      closest = knn.kneighbors(X[val_idx], max_k, return_distance=False)
+      closest_y = knn.y_train[closest]
+      y_val = y[val_idx]
+      for k in k_choices:
+        y_val_pred = knn._vote(closest_y[:, :k])
+        num_correct = np.sum(y_val_pred == y_val)
+        k_to_accuracies[k].append(float(num_correct) / len(y_val))
+    return k_to_accuracies
+
+  def start_serving(self, num_workers=None, query_block=1024):
+    """
+    Serve kneighbors (and so predict) from a pool of worker processes until
+    stop_serving is called or the classifier is trained again.
+
+    The training set is copied once into shared memory in its own dtype, and
+    split into num_workers contiguous shards, one per worker. kneighbors then
+    sends the test points query_block at a time to every worker, each worker
+    finds the k nearest points of its shard with the usual tiled search (with
+    an equal part of memory_budget), and the parent merges the shard results.
+    The results are the same as without workers. Compressed storage and
+    approximate indices are not used by the workers.
+
+    Inputs:
+    - num_workers: Number of processes; None uses one per CPU.
+    - query_block: Number of test points sent to the workers per task.
+    """
+    self.stop_serving()
+    if num_workers is None:
+      num_workers = multiprocessing.cpu_count()
+    num_train, dim = self.X_train.shape
+    num_workers = max(1, min(num_workers, num_train))
+
+    buf = shared_copy(self.X_train)[0]
+    bounds = np.linspace(0, num_train, num_workers + 1).astype(int)
+    self._shards = list(zip(bounds[:-1], bounds[1:]))
+    self._query_block = query_block
+    self._pool = multiprocessing.Pool(
+      num_workers, _init_knn_worker,
+      (buf, (num_train, dim), self.X_train.dtype,
+       self.memory_budget // num_workers, self.dtype, self.metric))
+
+  def stop_serving(self):
+    """ shut down the worker processes started by start_serving, if any """
+    if getattr(self, '_pool', None) is not None:
+      self._pool.close()
+      self._pool.join()
+    self._pool = None
+
+  def _kneighbors_sharded(self, X, k, return_distance):
+    """ kneighbors over the shards held by the worker processes """
+    num_test = X.shape[0]
+    dists = np.zeros((num_test, k))
+    idx = np.zeros((num_test, k), dtype=np.intp)
+    blocks = [(start, min(start + self._query_block, num_test))
+              for start in xrange(0, num_test, self._query_block)]
+    tasks = [(np.asarray(X[start:stop], dtype=np.float64), shard, k)
+             for start, stop in blocks for shard in self._shards]
+    results = self._pool.imap(_knn_shard_search, tasks)
+    for start, stop in blocks:
+      # results come back in task order, one per shard of this block
+      shard_results = [next(results) for shard in self._shards]
+      best_dists = np.hstack([r[0] for r in shard_results])
+      best_idx = np.hstack([r[1] for r in shard_results])
+      rows = np.arange(stop - start)[:, np.newaxis]
+      keep = np.lexsort((best_idx, best_dists))[:, :k]
+      dists[start:stop] = best_dists[rows, keep]
+      idx[start:stop] = best_idx[rows, keep]
+
+    if not return_distance:
+      return idx
+    return dists, idx
+
+  def _is_l2(self):
+    return isinstance(self.metric, L2Metric)
+
+  def _rerank(self, X, candidates, k):
+    """
+    Keep the k of the candidate training points of each row of X that are
+    nearest by exact distance; returns their squared distances and indices.
+    """
+    num_test, num_candidates = candidates.shape
+    dists = np.zeros(candidates.shape)
+    # gather the candidates of a few test points at a time
+    bytes_per_row = 8 * num_candidates * X.shape[1]
+    block = max(1, self.memory_budget // bytes_per_row)
+    for start in xrange(0, num_test, block):
+      stop = min(start + block, num_test)
+      diff = np.asarray(self.X_train[candidates[start:stop]], dtype=np.float64)
+      diff -= np.asarray(X[start:stop], dtype=np.float64)[:, np.newaxis]
+      dists[start:stop] = np.sum(np.square(diff, out=diff), axis=2)
+    rows = np.arange(num_test)[:, np.newaxis]
+    keep = _top_k(dists, k)
+    return dists[rows, keep], candidates[rows, keep]
+
+  def _kneighbors_index(self, X, k, return_distance, index, nprobe):
+    """ kneighbors through the approximate index built by train """
+    if index != 'ivf':
+      raise ValueError('Invalid index "%s"' % index)
+    if self.index is None:
+      raise ValueError('No "%s" index; pass index="%s" to train' % (index,
+                                                                     index))
+    dists, idx = self.index.search(X, k, nprobe)
+    # The probed lists can hold fewer than k points; search those test
+    # points exactly instead.
+    short = np.flatnonzero(idx[:, -1] < 0)
+    if short.size:
+      dists[short], idx[short] = self.kneighbors(X[short], k)
+      dists[short] **= 2
+    if not return_distance:
+      return idx
+    np.maximum(dists, 0, out=dists)
+    return np.sqrt(dists, out=dists), idx
+
+  def index_report(self, X, k=1, nprobes=(1, 2, 4, 8, 16), verbose=True):
+    """
+    Measure the recall and throughput of the approximate index built by train
+    against the exact search, to help choose nprobe.
+
+    Inputs:
+    - X: A numpy array of shape (num_test, D) containing test data.
+    - k: The number of neighbors to find.
+    - nprobes: The values of nprobe to try.
+    - verbose: Whether to print a line per setting.
+
+    Returns:
+    A list of dicts with the keys 'nprobe', 'recall' and 'queries_per_sec',
+    one for the exact search (with nprobe None and a recall of 1) followed
+    by one per value in nprobes. The recall is the fraction of the exact k
+    nearest neighbors that the approximate search finds.
+    """
+    num_test = X.shape[0]
+    tic = time.time()
+    exact = self.kneighbors(X, k, return_distance=False)
+    exact_time = time.time() - tic
+    results = [{'nprobe': None, 'recall': 1.0,
+                'queries_per_sec': num_test / max(exact_time, 1e-12)}]
+    for nprobe in nprobes:
+      tic = time.time()
+      idx = self.kneighbors(X, k, return_distance=False, index='ivf',
+                            nprobe=nprobe)
+      elapsed = time.time() - tic
+      found = sum(np.intersect1d(idx[i], exact[i]).size
+                  for i in xrange(num_test))
+      results.append({'nprobe': nprobe, 'recall': found / float(exact.size),
+                      'queries_per_sec': num_test / max(elapsed, 1e-12)})
+    if verbose:
+      for result in results:
+        name = 'exact' if result['nprobe'] is None else \
+               'nprobe %d' % result['nprobe']
+        print('%s: recall %f, %.0f queries/sec' % (
+          name, result['recall'], result['queries_per_sec']))
+    return results
+
+  def _block_sizes(self, num_test, num_train, k, train_row_bytes=0,
+                   test_row_bytes=0):
+    """
+    Pick the shape of the distance tiles used by kneighbors. Every tile entry
+    costs 16 bytes: the distance, and its index while taking the top k. Every
+    training and test point in a tile also costs train_row_bytes and
+    test_row_bytes for its converted copy, when one is made.
+    Whole rows of num_train distances are used as long as a reasonable number
+    of them fit in the budget; otherwise the training set is split too.
+    """
+    min_test_block = min(num_test, 64)
+    budget = self.memory_budget - num_train * train_row_bytes
+    test_block = max(0, budget) // (16 * num_train + test_row_bytes)
+    if test_block >= min_test_block:
+      return min(num_test, test_block), num_train
+    budget = self.memory_budget - min_test_block * test_row_bytes
+    train_block = budget // (16 * min_test_block + train_row_bytes)
+    return min_test_block, min(num_train, max(k, train_block))
+
+  def _vote(self, closest_y):
+    """
+    Given an array of shape (num_test, k) with the labels of the k nearest
+    neighbors of each test point, return the most common label of each row,
+    breaking ties by choosing the smaller label.
+
+    All rows are counted with a single bincount, by offsetting the labels of
+    row i by i * num_classes.
+    """
+    num_test = closest_y.shape[0]
+    num_classes = closest_y.max() + 1 if closest_y.size else 1
+    offsets = np.arange(num_test)[:, np.newaxis] * num_classes
+    counts = np.bincount((closest_y + offsets).ravel(),
+                         minlength=num_test * num_classes)
+    # argmax returns the first, i.e. smallest, of equally common labels
+    y_pred = np.zeros(num_test)
+    y_pred[:] = np.argmax(counts.reshape(num_test, num_classes), axis=1)
+    return y_pred
+
   def compute_distances_two_loops(self, X):
     """
     Compute the distance between each test point in X and each training point
@@ -108,9 +593,6 @@ class KNearestNeighbor(object):
 
     Input / Output: Same as compute_distances_two_loops
     """
-    num_test = X.shape[0]
-    num_train = self.X_train.shape[0]
-    dists = np.zeros((num_test, num_train)) 
     #########################################################################
     # TODO:                                                                 #
     # Compute the l2 distance between all test points and all training      #
@@ -123,12 +605,16 @@ class KNearestNeighbor(object):
     # HINT: Try to formulate the l2 distance using matrix multiplication    #
     #       and two broadcast sums.                                         #
     #########################################################################
-    dists = np.multiply(np.dot(X, self.X_train.T), -2)
-    sq1 = np.sum(np.square(X), axis = 1, keepdims=True)
-    sq2 = np.sum(np.square(self.X_train), axis = 1)
-    dists = np.add(sq1, dists)
-    dists = np.add(sq2, dists)
-    dists = np.sqrt(dists)
+    # A single matrix product allocates dists; the norm terms are then added
+    # in place, using the cached norms of the training points.
+    X = np.asarray(X, dtype=self.dtype)
+    dists = np.dot(X, np.asarray(self.X_train, dtype=self.dtype).T)
+    dists *= -2
+    dists += np.sum(np.square(X), axis=1, keepdims=True)
+    dists += self._train_norms().astype(self.dtype, copy=False)
+    # round-off can make the squared distance of (near) duplicates negative
+    np.maximum(dists, 0, out=dists)
+    np.sqrt(dists, out=dists)
     #########################################################################
     #                         END OF YOUR CODE                              #
     #########################################################################
@@ -147,42 +633,396 @@ class KNearestNeighbor(object):
     - y: A numpy array of shape (num_test,) containing predicted labels for the
       test data, where y[i] is the predicted label for the test point X[i].  
     """
-    num_test = dists.shape[0]
-    y_pred = np.zeros(num_test)
-    for i in xrange(num_test):
-      # A list of length k storing the labels of the k nearest neighbors to
-      # the ith test point.
-      closest_y = []
-      #########################################################################
-      # TODO:                                                                 #
-      # Use the distance matrix to find the k nearest neighbors of the ith    #
-      # testing point, and use self.y_train to find the labels of these       #
-      # neighbors. Store these labels in closest_y.                           #
-      # Hint: Look up the function numpy.argsort.                             #
-      #########################################################################
-      closest_y = self.y_train[np.argsort(dists[i,:])[:k]] 
-      #closest_y = np.argsort(dists[i]).tolist()
-      #########################################################################
-      # TODO:                                                                 #
-      # Now that you have found the labels of the k nearest neighbors, you    #
-      # need to find the most common label in the list closest_y of labels.   #
-      # Store this label in y_pred[i]. Break ties by choosing the smaller     #
-      # label.                                                                #
-      #########################################################################
-      y_pred[i] = np.argmax(np.bincount(closest_y))
-      '''
-      labels = self.y_train[closest_y[:k]].tolist()
-      label_count = {}
-      for label in labels:
-        label_count[label] = label_count.get(label, 0) + 1
-      y_pred[i] = labels[0]
-      for label in labels:
-        if label_count[label] > label_count[y_pred[i]]:
-          y_pred[i] = label  
-      '''
-      #########################################################################
-      #                           END OF YOUR CODE                            # 
-      #########################################################################
+    # Find the k nearest neighbors of all test points at once. Of training
+    # points at the same distance the ones with smaller indices are nearer,
+    # as with a stable sort.
+    closest = _top_k(dists, k)
+    # Vote among the labels of the neighbors, breaking ties by choosing the
+    # smaller label.
+    return self._vote(self.y_train[closest])
+
+
+class CompressedGallery(object):
+  """
+  A compressed copy of a training set for the distance computations of
+  KNearestNeighbor.kneighbors. Vectors are decoded one block at a time into
+  float32, so the distances are computed with float32 matrix products.
+
+  Storage formats:
+  - 'float16': the vectors rounded to half precision.
+  - 'int8': every dimension linearly quantized to 256 levels between its
+    minimum and maximum over the training set.
+  - 'pca': the projection of the centered vectors onto their pca_dim
+    principal components, in float32. Test points are projected the same
+    way, so distances are only computed in the pca_dim dimensional space.
+  """
+
+  def __init__(self, X, storage, pca_dim=None, block_size=4096):
+    """
+    Compress X, block_size rows at a time.
+
+    Inputs:
+    - X: A numpy array of shape (N, D) containing the vectors.
+    - storage: 'float16', 'int8' or 'pca'.
+    - pca_dim: Number of principal components for 'pca'.
+    - block_size: Number of rows converted to float64 at a time.
+    """
+    num_points, dim = X.shape
+    self.storage = storage
+    if storage == 'float16':
+      self.codes = np.empty((num_points, dim), dtype=np.float16)
+    elif storage == 'int8':
+      low = np.min(X, axis=0).astype(np.float64)
+      high = np.max(X, axis=0).astype(np.float64)
+      self.offset = low
+      self.scale = (high - low) / 255
+      self.scale[self.scale == 0] = 1
+      self.codes = np.empty((num_points, dim), dtype=np.int8)
+    elif storage == 'pca':
+      if pca_dim is None or not 1 <= pca_dim <= dim:
+        raise ValueError('Invalid value %s for pca_dim' % pca_dim)
+      self.mean = np.zeros(dim)
+      for start in xrange(0, num_points, block_size):
+        self.mean += np.sum(X[start:start + block_size], axis=0,
+                            dtype=np.float64)
+      self.mean /= num_points
+      cov = np.zeros((dim, dim))
+      for start in xrange(0, num_points, block_size):
+        centered = X[start:start + block_size] - self.mean
+        cov += np.dot(centered.T, centered)
+      eigvals, eigvecs = np.linalg.eigh(cov)
+      # eigh sorts the eigenvalues in increasing order
+      self.components = eigvecs[:, ::-1][:, :pca_dim].astype(np.float32)
+      self.codes = np.empty((num_points, pca_dim), dtype=np.float32)
+    else:
+      raise ValueError('Invalid storage "%s"' % storage)
+
+    self.sq_norms = np.zeros(num_points, dtype=np.float32)
+    for start in xrange(0, num_points, block_size):
+      stop = min(start + block_size, num_points)
+      block = X[start:stop]
+      if storage == 'float16':
+        self.codes[start:stop] = block
+      elif storage == 'int8':
+        levels = np.rint((block - self.offset) / self.scale) - 128
+        self.codes[start:stop] = np.clip(levels, -128, 127)
+      else:
+        self.codes[start:stop] = self.encode(block)
+      self.sq_norms[start:stop] = np.sum(np.square(self.decode(start, stop),
+                                                   dtype=np.float64), axis=1)
+
+  def encode(self, X):
+    """ float32 test points in the space of the decoded vectors """
+    if self.storage == 'pca':
+      return np.dot((X - self.mean).astype(np.float32), self.components)
+    return np.asarray(X, dtype=np.float32)
+
+  def decode(self, start, stop):
+    """ the vectors start:stop in float32 """
+    codes = self.codes[start:stop]
+    if self.storage == 'int8':
+      block = codes.astype(np.float32)
+      block += 128
+      block *= self.scale.astype(np.float32)
+      block += self.offset.astype(np.float32)
+      return block
+    return codes.astype(np.float32, copy=False)
+
+  @property
+  def nbytes(self):
+    """ memory used by the compressed vectors """
+    return self.codes.nbytes
+
+
+class IVFIndex(object):
+  """
+  An inverted file index for approximate nearest neighbor search. The points
+  are clustered with k-means and stored grouped by their nearest centroid,
+  one list per cluster; a query then only computes distances to the points
+  in the lists of its nprobe nearest centroids.
+
+  The index keeps a copy of the points reordered by list, so that each list
+  is a contiguous block for the distance computation.
+  """
+
+  def __init__(self, X, num_lists, num_iters=10, max_points_per_list=256,
+               memory_budget=2 ** 28, seed=0):
+    """
+    Build the index.
+
+    Inputs:
+    - X: A numpy array of shape (N, D) containing the points to index.
+    - num_lists: Number of k-means clusters.
+    - num_iters: Number of k-means iterations.
+    - max_points_per_list: k-means runs on a random sample of at most
+      num_lists * max_points_per_list points; all points are then assigned.
+    - memory_budget: Scratch memory for the distance tiles, as for
+      KNearestNeighbor.
+    - seed: Seed of the k-means initialization and sample.
+    """
+    num_points = X.shape[0]
+    num_lists = max(1, min(num_lists, num_points))
+    self.memory_budget = memory_budget
+    rng = np.random.RandomState(seed)
+
+    sample = X
+    if num_points > num_lists * max_points_per_list:
+      sample = X[np.sort(rng.choice(num_points, num_lists * max_points_per_list,
+                                    replace=False))]
+    sample = np.asarray(sample, dtype=np.float64)
+    centroids = sample[rng.choice(sample.shape[0], num_lists, replace=False)]
+    for it in xrange(num_iters):
+      assignment = self._assign(centroids, sample)
+      counts = np.bincount(assignment, minlength=num_lists)
+      order = np.argsort(assignment, kind='mergesort')
+      starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+      nonempty = counts > 0
+      sums = np.add.reduceat(sample[order], starts[nonempty], axis=0)
+      centroids[nonempty] = sums / counts[nonempty][:, np.newaxis]
+      # restart empty clusters at random sample points
+      empty = np.flatnonzero(~nonempty)
+      centroids[empty] = sample[rng.choice(sample.shape[0], empty.size)]
+
+    assignment = self._assign(centroids, X)
+    self.centroids = centroids
+    self.order = np.argsort(assignment, kind='mergesort')
+    self.list_starts = np.concatenate(
+      ([0], np.cumsum(np.bincount(assignment, minlength=num_lists))))
+    self.points = np.asarray(X, dtype=np.float64)[self.order]
+    self.points_sq = np.sum(np.square(self.points), axis=1)
+
+  def _assign(self, centroids, X):
+    """ index of the nearest centroid of every row of X """
+    knn = KNearestNeighbor(memory_budget=self.memory_budget)
+    knn.train(centroids, np.arange(centroids.shape[0]))
+    return knn.kneighbors(X, 1, return_distance=False)[:, 0]
+
+  def search(self, X, k, nprobe=1):
+    """
+    Find approximate k nearest neighbors of the rows of X.
+
+    Returns a tuple of:
+    - dists: A numpy array of shape (num_test, k) of squared distances, in
+      increasing order.
+    - idx: A numpy array of shape (num_test, k) of indices of the points
+      passed to the constructor. If the probed lists of a test point hold
+      fewer than k points its row is padded with index -1 and distance inf.
+    """
+    num_test = X.shape[0]
+    num_lists = self.centroids.shape[0]
+    X = np.asarray(X, dtype=np.float64)
+    test_sq = np.sum(np.square(X), axis=1)
+    best_dists = np.full((num_test, k), np.inf)
+    best_idx = np.full((num_test, k), -1, dtype=np.intp)
+
+    # Group the test points by probed list, so that each list is compared
+    # against all its test points with a single matrix product.
+    probes = self._nearest_lists(X, min(nprobe, num_lists))
+    probed_by = np.argsort(probes.ravel(), kind='mergesort')
+    probed_by_starts = np.searchsorted(probes.ravel()[probed_by],
+                                       np.arange(num_lists + 1))
+    for l in xrange(num_lists):
+      start, stop = self.list_starts[l], self.list_starts[l + 1]
+      queries = probed_by[probed_by_starts[l]:probed_by_starts[l + 1]]
+      queries //= probes.shape[1]
+      if start == stop or queries.size == 0:
+        continue
+      block = max(1, self.memory_budget // (16 * (stop - start)))
+      for q in xrange(0, queries.size, block):
+        rows = queries[q:q + block]
+        d = _squared_distances(X[rows], test_sq[rows], self.points[start:stop],
+                               self.points_sq[start:stop])
+        best_dists[rows], best_idx[rows] = _merge_top_k(
+          best_dists[rows], best_idx[rows], d, start, k)
+
+    found = best_idx >= 0
+    best_idx[found] = self.order[best_idx[found]]
+    order = np.lexsort((best_idx, best_dists))
+    rows = np.arange(num_test)[:, np.newaxis]
+    return best_dists[rows, order], best_idx[rows, order]
+
+  def _nearest_lists(self, X, nprobe):
+    knn = KNearestNeighbor(memory_budget=self.memory_budget)
+    knn.train(self.centroids, np.arange(self.centroids.shape[0]))
+    return knn.kneighbors(X, nprobe, return_distance=False)
+
+
+# Shared state of the worker processes started by
+# KNearestNeighbor.start_serving; filled in by _init_knn_worker.
+_knn_shared = {}
+
+def _init_knn_worker(buf, shape, train_dtype, memory_budget, dtype, metric):
+  _knn_shared['X_train'] = shared_view(buf, shape, train_dtype)
+  _knn_shared['memory_budget'] = memory_budget
+  _knn_shared['dtype'] = dtype
+  _knn_shared['metric'] = metric
+  _knn_shared['shards'] = {}
+
+def _knn_shard_search(task):
+  """
+  Find the k nearest points of one shard of the shared training set; returns
+  their distances and their indices into the whole training set.
+  """
+  X, (start, stop), k = task
+  # keep a classifier per shard, so its norms are only computed once
+  knn = _knn_shared['shards'].get((start, stop))
+  if knn is None:
+    knn = KNearestNeighbor(memory_budget=_knn_shared['memory_budget'],
+                           dtype=_knn_shared['dtype'],
+                           metric=_knn_shared['metric'])
+    knn.train(_knn_shared['X_train'][start:stop], None)
+    _knn_shared['shards'][(start, stop)] = knn
+  dists, idx = knn.kneighbors(X, min(k, stop - start))
+  return dists, idx + start
+
+
+def _squared_norms(X, block_size=2 ** 24):
+  """
+  Squared norms of the rows of X in float64, computed a few rows at a time
+  so that the float64 copy of a block stays under block_size bytes.
+  """
+  sq_norms = np.empty(X.shape[0])
+  rows = max(1, block_size // (8 * max(1, X.shape[1])))
+  for start in xrange(0, X.shape[0], rows):
+    block = np.asarray(X[start:start + rows], dtype=np.float64)
+    sq_norms[start:start + rows] = np.einsum('ij,ij->i', block, block)
+  return sq_norms
+
+
+def _squared_distances(X, X_sq, Y, Y_sq, out=None):
+  """
+  Squared Euclidean distances between the rows of X and Y given their
+  squared norms, built in place from a single matrix product as
+  ||x||^2 - 2 x.y + ||y||^2.
+  """
+  out = np.dot(X, Y.T, out=out)
+  out *= -2
+  out += X_sq[:, np.newaxis]
+  out += Y_sq
+  return out
+
+
+class L2Metric(object):
+  """
+  Euclidean distance. A metric fills tiles of distances for the tiled search
+  of KNearestNeighbor.kneighbors through two methods:
+
+  - tile(X, X_sq, Y, Y_sq, out): Fill out, of shape (len(X), len(Y)), with
+    values that rank the pairs of rows of X and Y like their distances,
+    given the squared norms X_sq and Y_sq of the rows.
+  - finish(dists): Turn an array of such values into distances in place and
+    return it.
+
+  Here tiles hold squared distances from _squared_distances.
+  """
+
+  def tile(self, X, X_sq, Y, Y_sq, out):
+    return _squared_distances(X, X_sq, Y, Y_sq, out)
+
+  def finish(self, dists):
+    # round-off can make the squared distance of (near) duplicates negative
+    np.maximum(dists, 0, out=dists)
+    return np.sqrt(dists, out=dists)
+
+
+class L1Metric(object):
+  """
+  Manhattan distance, sum_d |x_d - y_d|. There is no matrix product for it,
+  so each tile is filled by scipy's cdist, a block of rows at a time so that
+  the float64 array cdist returns stays within chunk_bytes before it is
+  copied into the tile. cdist works in float64, so tiles of another dtype
+  also cost one float64 copy of the training block.
+  """
+
+  def __init__(self, chunk_bytes=2 ** 22):
+    self.chunk_bytes = chunk_bytes
+
+  def tile(self, X, X_sq, Y, Y_sq, out):
+    Y = np.asarray(Y, dtype=np.float64)
+    rows = max(1, self.chunk_bytes // (8 * max(1, Y.shape[0])))
+    for i in xrange(0, X.shape[0], rows):
+      out[i:i + rows] = cdist(X[i:i + rows], Y, 'cityblock')
+    return out
+
+  def finish(self, dists):
+    return dists
+
+
+class CosineMetric(object):
+  """
+  Cosine distance, 1 - x.y / (||x|| ||y||), from a single matrix product
+  scaled by the norms, which come from the squared norms the classifier
+  caches. Points with a zero norm are at distance 1 from everything.
+  """
+
+  def tile(self, X, X_sq, Y, Y_sq, out):
+    out = np.dot(X, Y.T, out=out)
+    out /= _safe_norms(X_sq)[:, np.newaxis]
+    out /= _safe_norms(Y_sq)
+    return np.subtract(1, out, out=out)
+
+  def finish(self, dists):
+    # round-off can take the distance of parallel vectors below 0
+    return np.clip(dists, 0, 2, out=dists)
+
+
+def _safe_norms(sq_norms):
+  """ norms from squared norms, with zeros replaced by ones """
+  norms = np.sqrt(sq_norms)
+  norms[norms == 0] = 1
+  return norms
+
+
+METRICS = {
+  'l2': L2Metric,
+  'l1': L1Metric,
+  'cosine': CosineMetric,
+}
+
+
+def _merge_top_k(best_dists, best_idx, dists, offset, k):
+  """
+  Merge the running k smallest distances of each row (None at the start) with
+  a new tile of distances whose columns are the training points starting at
+  offset. Returns the new k smallest distances and their training indices,
+  ordered by distance. Of equally distant points the ones with smaller
+  indices are kept, as long as all running indices are below offset.
+  """
+  rows = np.arange(dists.shape[0])[:, np.newaxis]
+  cand_idx = _top_k(dists, k)
+  cand_dists = dists[rows, cand_idx]
+  cand_idx += offset
+  if best_dists is None:
+    return cand_dists, cand_idx
+  # equal distances are in index order within both halves
+  cand_dists = np.hstack((best_dists, cand_dists))
+  cand_idx = np.hstack((best_idx, cand_idx))
+  keep = _top_k(cand_dists, k)
+  return cand_dists[rows, keep], cand_idx[rows, keep]
 
-    return y_pred
 
+def _top_k(dists, k):
+  """
+  Return an array of shape (num_test, k) with the column indices of the k
+  smallest entries of every row of dists, ordered by distance and then by
+  index, i.e. the first k columns of a stable argsort of each row, but found
+  with a single argpartition over all rows.
+  """
+  num_test, num_train = dists.shape
+  k = min(k, num_train)
+  if k < num_train:
+    closest = np.argpartition(dists, k - 1, axis=1)[:, :k]
+  else:
+    closest = np.tile(np.arange(num_train), (num_test, 1))
+  rows = np.arange(num_test)[:, np.newaxis]
+  closest_dists = dists[rows, closest]
+  # argpartition picks arbitrarily among points tied with the kth distance;
+  # redo the (rare) rows where that choice matters with a stable sort.
+  kth = closest_dists.max(axis=1)
+  ties = np.flatnonzero(
+    np.sum(dists <= kth[:, np.newaxis], axis=1) > k)
+  if ties.size:
+    closest[ties] = np.argsort(dists[ties], axis=1, kind='mergesort')[:, :k]
+    closest_dists[ties] = dists[ties[:, np.newaxis], closest[ties]]
+  order = np.lexsort((closest, closest_dists))
+  return closest[rows, order]
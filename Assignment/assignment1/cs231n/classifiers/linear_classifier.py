@@ -1,6 +1,8 @@
 from __future__ import print_function
 
 import numpy as np
+from scipy.optimize import minimize
+from cs231n.batching import BatchGatherer
 from cs231n.classifiers.linear_svm import *
 from cs231n.classifiers.softmax import *
 from past.builtins import xrange
@@ -12,9 +14,10 @@ class LinearClassifier(object):
     self.W = None
 
   def train(self, X, y, learning_rate=1e-3, reg=1e-5, num_iters=100,
-            batch_size=200, verbose=False):
+            batch_size=200, verbose=False, solver='sgd', tol=1e-6):
     """
-    Train this linear classifier using stochastic gradient descent.
+    Train this linear classifier using stochastic gradient descent, or a
+    full-batch L-BFGS or conjugate gradient optimizer.
 
     Inputs:
     - X: A numpy array of shape (N, D) containing training data; there are N
@@ -26,6 +29,13 @@ class LinearClassifier(object):
     - num_iters: (integer) number of steps to take when optimizing
     - batch_size: (integer) number of training examples to use at each step.
     - verbose: (boolean) If true, print progress during optimization.
+    - solver: 'sgd' for minibatch stochastic gradient descent with a fixed
+      learning rate, or 'lbfgs' / 'cg' to minimize the loss over the whole
+      training set with scipy.optimize's L-BFGS or nonlinear conjugate
+      gradient method, which pick their own step sizes with a line search.
+      These usually converge in tens of iterations; learning_rate and
+      batch_size are then ignored and num_iters caps the iterations.
+    - tol: (float) convergence tolerance of the 'lbfgs' and 'cg' solvers.
 
     Outputs:
     A list containing the value of the loss function at each training iteration.
@@ -33,11 +43,19 @@ class LinearClassifier(object):
     num_train, dim = X.shape
     num_classes = np.max(y) + 1 # assume y takes values 0...K-1 where K is number of classes
     if self.W is None:
-      # lazily initialize W
+      # lazily initialize W, in float32 if X is, so the loss stays in float32
       self.W = 0.001 * np.random.randn(dim, num_classes)
+      if X.dtype == np.float32:
+        self.W = self.W.astype(np.float32)
+    if solver in ('lbfgs', 'cg'):
+      return self._train_full_batch(X, y, reg, num_iters, verbose, solver,
+                                    tol)
+    elif solver != 'sgd':
+      raise ValueError('Invalid solver "%s"' % solver)
 
     # Run stochastic gradient descent to optimize W
     loss_history = []
+    gatherer = BatchGatherer(X, y)
     for it in xrange(num_iters):
       X_batch = None
       y_batch = None
@@ -55,8 +73,7 @@ class LinearClassifier(object):
       #########################################################################
       index = np.random.choice(num_train, batch_size, replace=True)
       
-      X_batch = X[index, :]
-      y_batch = y[index]
+      X_batch, y_batch = gatherer.gather(index)
       #########################################################################
       #                       END OF YOUR CODE                                #
       #########################################################################
@@ -80,14 +97,101 @@ class LinearClassifier(object):
 
     return loss_history
 
-  def predict(self, X):
+  def _train_full_batch(self, X, y, reg, num_iters, verbose, solver, tol):
+    """
+    Minimize the full-batch loss over W with scipy.optimize.minimize; see
+    train.
+    """
+    shape, dtype = self.W.shape, self.W.dtype
+    last_loss = [None]
+
+    def loss_and_grad(w):
+      self.W = w.reshape(shape)
+      loss, grad = self.loss(X, y, reg)
+      last_loss[0] = loss
+      # copy the gradient, which the loss may overwrite on its next call
+      return loss, grad.astype(np.float64).ravel()
+
+    loss_history = []
+    def record(w):
+      # the line search ends by evaluating the accepted point
+      loss_history.append(last_loss[0])
+      if verbose and len(loss_history) % 10 == 0:
+        print('iteration %d / %d: loss %f' % (len(loss_history), num_iters,
+                                              last_loss[0]))
+
+    method = {'lbfgs': 'L-BFGS-B', 'cg': 'CG'}[solver]
+    result = minimize(loss_and_grad, self.W.astype(np.float64).ravel(),
+                      jac=True, method=method, tol=tol, callback=record,
+                      options={'maxiter': num_iters})
+    # the optimizer works in float64; keep W in the dtype SGD would use
+    self.W = result.x.reshape(shape).astype(dtype, copy=False)
+    return loss_history
+
+  @classmethod
+  def sweep(cls, X, y, X_val, y_val, learning_rates, regularization_strengths,
+            num_iters=100, batch_size=200, verbose=False):
+    """
+    Train one classifier for every (learning rate, regularization strength)
+    pair with stochastic gradient descent, all at the same time.
+
+    The weights of the K = len(learning_rates) * len(regularization_strengths)
+    classifiers are stacked into a single (D, K, C) array, and every step
+    draws one minibatch that they all share. The scores and gradients of the
+    whole grid then each take one matrix product with the minibatch (see
+    stacked_loss) rather than K separate ones.
+
+    Inputs:
+    - X, y: Training data and labels, as for train.
+    - X_val, y_val: Validation data and labels.
+    - learning_rates, regularization_strengths: Lists of the values to try.
+    - num_iters, batch_size, verbose: As for train.
+
+    Returns a tuple of:
+    - results: A dictionary mapping each (learning_rate, reg) pair to a tuple
+      (training accuracy, validation accuracy).
+    - best: The classifier with the highest validation accuracy, an instance
+      of this class.
+    """
+    grid = [(lr, reg) for lr in learning_rates
+            for reg in regularization_strengths]
+    lrs = np.array([lr for lr, reg in grid])
+    regs = np.array([reg for lr, reg in grid])
+    num_train, dim = X.shape
+    num_classes = np.max(y) + 1
+    W = 0.001 * np.random.randn(dim, len(grid), num_classes)
+
+    classifier = cls()
+    gatherer = BatchGatherer(X, y)
+    for it in xrange(num_iters):
+      index = np.random.choice(num_train, batch_size, replace=True)
+      X_batch, y_batch = gatherer.gather(index)
+      loss, grad = classifier.stacked_loss(W, X_batch, y_batch, regs)
+      grad *= lrs[:, np.newaxis]
+      W -= grad
+
+      if verbose and it % 100 == 0:
+        print('iteration %d / %d: loss %f to %f' % (it, num_iters, loss.min(),
+                                                    loss.max()))
+
+    train_acc = _stacked_accuracy(W, X, y)
+    val_acc = _stacked_accuracy(W, X_val, y_val)
+    results = {}
+    for i, params in enumerate(grid):
+      results[params] = (train_acc[i], val_acc[i])
+    best = cls()
+    best.W = W[:, np.argmax(val_acc)].copy()
+    return results, best
+
+  def predict(self, X, block_size=1000):
     """
     Use the trained weights of this linear classifier to predict labels for
     data points.
 
     Inputs:
     - X: A numpy array of shape (N, D) containing training data; there are N
-      training samples each of dimension D.
+      training samples each of dimension D. X is scored block_size rows at a
+      time, so it can also be an array-like such as a LazyImageArray.
 
     Returns:
     - y_pred: Predicted labels for the data in X. y_pred is a 1-dimensional
@@ -99,8 +203,10 @@ class LinearClassifier(object):
     # TODO:                                                                   #
     # Implement this method. Store the predicted labels in y_pred.            #
     ###########################################################################
-    scores = X.dot(self.W)
-    y_pred = np.argmax(scores, axis=1)
+    y_pred = np.zeros(X.shape[0], dtype=np.intp)
+    for start in xrange(0, X.shape[0], block_size):
+      scores = X[start:start + block_size].dot(self.W)
+      y_pred[start:start + block_size] = np.argmax(scores, axis=1)
     ###########################################################################
     #                           END OF YOUR CODE                              #
     ###########################################################################
@@ -123,12 +229,31 @@ class LinearClassifier(object):
     """
     pass
 
+  def stacked_loss(self, W, X_batch, y_batch, reg):
+    """
+    Compute the loss function and its derivative for a stack of weights, as
+    svm_loss_stacked does. Subclasses will override this.
+    """
+    pass
+
 
 class LinearSVM(LinearClassifier):
-  """ A subclass that uses the Multiclass SVM loss function """
+  """
+  A subclass that uses the Multiclass SVM loss function. The loss buffers
+  are kept between calls, so the gradient returned by loss is overwritten
+  by the next call.
+  """
+
+  def __init__(self):
+    super(LinearSVM, self).__init__()
+    self._workspace = {}
 
   def loss(self, X_batch, y_batch, reg):
-    return svm_loss_vectorized(self.W, X_batch, y_batch, reg)
+    return svm_loss_vectorized(self.W, X_batch, y_batch, reg,
+                               workspace=self._workspace)
+
+  def stacked_loss(self, W, X_batch, y_batch, reg):
+    return svm_loss_stacked(W, X_batch, y_batch, reg)
 
 
 class Softmax(LinearClassifier):
@@ -137,3 +262,21 @@ class Softmax(LinearClassifier):
   def loss(self, X_batch, y_batch, reg):
     return softmax_loss_vectorized(self.W, X_batch, y_batch, reg)
 
+  def stacked_loss(self, W, X_batch, y_batch, reg):
+    return softmax_loss_stacked(W, X_batch, y_batch, reg)
+
+
+def _stacked_accuracy(W, X, y, block_size=1000):
+  """
+  Accuracy on X, y of each of the classifiers whose weights are stacked in
+  W, of shape (D, K, C); returns an array of shape (K,).
+  """
+  dim, num_stacked, num_classes = W.shape
+  num_correct = np.zeros(num_stacked)
+  for start in xrange(0, X.shape[0], block_size):
+    scores = X[start:start + block_size].dot(W.reshape(dim, -1))
+    y_pred = np.argmax(scores.reshape(-1, num_stacked, num_classes), axis=2)
+    num_correct += np.sum(y_pred == y[start:start + block_size, np.newaxis],
+                          axis=0)
+  return num_correct / X.shape[0]
+
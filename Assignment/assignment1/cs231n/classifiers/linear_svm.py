@@ -2,6 +2,8 @@ import numpy as np
 from random import shuffle
 from past.builtins import xrange
 
+from cs231n.workspace import workspace_array
+
 def svm_loss_naive(W, X, y, reg):
   """
   Structured SVM loss function, naive implementation (with loops).
@@ -57,30 +59,49 @@ def svm_loss_naive(W, X, y, reg):
   return loss, dW
 
 
-def svm_loss_vectorized(W, X, y, reg):
+def svm_loss_vectorized(W, X, y, reg, workspace=None):
   """
   Structured SVM loss function, vectorized implementation.
 
-  Inputs and outputs are the same as svm_loss_naive.
+  Inputs and outputs are the same as svm_loss_naive, plus:
+  - workspace: Optional dict in which the scores and gradient buffers are
+    kept. Passing the same dict to repeated calls reuses them instead of
+    allocating new ones; the gradient returned is then overwritten by the
+    next call.
+
+  The margins are computed in place in the score matrix, which is then
+  turned into the margin indicator and finally into the gradient of the
+  loss with respect to the scores, so the only N x C array is the scores.
+  Everything is computed in the precision of W and X, so float32 inputs
+  stay float32.
   """
   loss = 0.0
-  dW = np.zeros(W.shape) # initialize the gradient as zero
-
   num_train = X.shape[0]
-  #num_classes = W.shape[1]
+  dtype = np.result_type(W, X)
 
   #############################################################################
   # TODO:                                                                     #
   # Implement a vectorized version of the structured SVM loss, storing the    #
   # result in loss.                                                           #
   #############################################################################
-  scores = X.dot(W)
-  correct_scores = scores[np.arange(num_train), y].reshape(-1, 1)
-
-  margins = np.maximum([0], scores - correct_scores + 1)
-  margins[np.arange(num_train), y] = 0
-
-  loss = np.sum(margins)/num_train + reg * np.sum(W * W)
+  rows = None if workspace is None else workspace.get('rows')
+  if rows is None or rows.size < num_train:
+    rows = np.arange(num_train)
+    if workspace is not None:
+      workspace['rows'] = rows
+  rows = rows[:num_train]
+  scores = workspace_array(workspace, 'scores', (num_train, W.shape[1]),
+                           dtype)
+  np.dot(X, W, out=scores)
+  correct_scores = scores[rows, y]
+  correct_scores -= 1
+
+  # margins, in place
+  scores -= correct_scores[:, np.newaxis]
+  np.maximum(scores, 0, out=scores)
+  scores[rows, y] = 0
+
+  loss = np.sum(scores) / num_train + reg * np.vdot(W, W)
 
   #############################################################################
   #                             END OF YOUR CODE                              #
@@ -96,17 +117,56 @@ def svm_loss_vectorized(W, X, y, reg):
   # to reuse some of the intermediate values that you used to compute the     #
   # loss.                                                                     #
   #############################################################################
-  mask = margins
-
-  mask[margins > 0] = 1
-  col_sum = np.sum(mask, axis=1)
-
-  mask[np.arange(num_train), y] = -col_sum[np.arange(num_train)]
-
-  dW = np.dot(X.T, mask)
-  dW = dW/num_train + 2 * reg * W
+  # margins are >= 0, so their sign is the indicator of margins > 0
+  mask = np.sign(scores, out=scores)
+  mask[rows, y] = -np.sum(mask, axis=1)
+  mask /= num_train
+
+  dW = workspace_array(workspace, 'dW', W.shape, dtype)
+  np.dot(X.T, mask, out=dW)
+  reg_grad = workspace_array(workspace, 'reg_grad', W.shape, dtype)
+  np.multiply(W, 2 * reg, out=reg_grad)
+  dW += reg_grad
   #############################################################################
   #                             END OF YOUR CODE                              #
   #############################################################################
 
   return loss, dW
+
+
+def svm_loss_stacked(W, X, y, reg):
+  """
+  Structured SVM loss function of K linear classifiers at once, e.g. one per
+  hyperparameter setting of a sweep. The scores of all of them come from one
+  matrix product of X with the (D, K * C) stack of weights, and the
+  gradients from one product with X.T.
+
+  Inputs:
+  - W: A numpy array of shape (D, K, C) containing the weights of the K
+    classifiers; W[:, i] is the weight matrix of the ith.
+  - X, y: A minibatch, as for svm_loss_naive.
+  - reg: A numpy array of shape (K,) with the regularization strength of each
+    classifier.
+
+  Returns a tuple of:
+  - loss: A numpy array of shape (K,) with the loss of each classifier
+  - gradient with respect to weights W; an array of same shape as W
+  """
+  num_train = X.shape[0]
+  dim, num_stacked, num_classes = W.shape
+  rows = np.arange(num_train)
+  scores = X.dot(W.reshape(dim, -1)).reshape(num_train, num_stacked,
+                                             num_classes)
+  margins = scores - scores[rows, :, y][:, :, np.newaxis]
+  margins += 1
+  np.maximum(margins, 0, out=margins)
+  margins[rows, :, y] = 0
+  loss = np.sum(margins, axis=(0, 2)) / num_train
+  loss += reg * np.einsum('dkc,dkc->k', W, W)
+
+  mask = (margins > 0).astype(W.dtype)
+  mask[rows, :, y] = -np.sum(mask, axis=2)
+  dW = X.T.dot(mask.reshape(num_train, -1)).reshape(W.shape)
+  dW /= num_train
+  dW += 2 * reg[:, np.newaxis] * W
+  return loss, dW
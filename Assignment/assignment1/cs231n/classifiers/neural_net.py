@@ -3,6 +3,8 @@ from __future__ import print_function
 import numpy as np
 import matplotlib.pyplot as plt
 from past.builtins import xrange
+from cs231n.batching import BatchGatherer
+from cs231n.classifiers.softmax import softmax_cross_entropy
 
 class TwoLayerNet(object):
   """
@@ -95,10 +97,8 @@ class TwoLayerNet(object):
     # in the variable loss, which should be a scalar. Use the Softmax           #
     # classifier loss.                                                          #
     #############################################################################
-    scores = scores - np.max(scores, axis=1, keepdims=True)
-    exp_sum = np.sum(np.exp(scores), axis=1, keepdims=True)
-    loss = -np.sum(scores[xrange(N), y]) + np.sum(np.log(exp_sum))
-    loss = loss / N + reg * (np.sum(W1 * W1) + np.sum(W2 * W2))
+    loss, prob = softmax_cross_entropy(scores, y, out=scores)
+    loss += reg * (np.vdot(W1, W1) + np.vdot(W2, W2))
     #############################################################################
     #                              END OF YOUR CODE                             #
     #############################################################################
@@ -110,10 +110,6 @@ class TwoLayerNet(object):
     # and biases. Store the results in the grads dictionary. For example,       #
     # grads['W1'] should store the gradient on W1, and be a matrix of same size #
     #############################################################################
-    prob = np.exp(scores) / exp_sum
-    prob[xrange(N), y] -= 1
-    prob /= N
-
     grads['b2'] = np.sum(prob, axis=0)
     grads['W2'] = scores_mid.T.dot(prob) + 2 * reg * W2
 
@@ -156,6 +152,7 @@ class TwoLayerNet(object):
     loss_history = []
     train_acc_history = []
     val_acc_history = []
+    gatherer = BatchGatherer(X, y)
 
     for it in xrange(num_iters):
       X_batch = None
@@ -166,8 +163,7 @@ class TwoLayerNet(object):
       # them in X_batch and y_batch respectively.                             #
       #########################################################################
       sample_indice = np.random.choice(range(num_train), batch_size)
-      X_batch = X[sample_indice]
-      y_batch = y[sample_indice]
+      X_batch, y_batch = gatherer.gather(sample_indice)
       #########################################################################
       #                             END OF YOUR CODE                          #
       #########################################################################
@@ -211,7 +207,7 @@ class TwoLayerNet(object):
       'val_acc_history': val_acc_history,
     }
 
-  def predict(self, X):
+  def predict(self, X, block_size=1000):
     """
     Use the trained weights of this two-layer network to predict labels for
     data points. For each data point we predict scores for each of the C
@@ -219,7 +215,8 @@ class TwoLayerNet(object):
 
     Inputs:
     - X: A numpy array of shape (N, D) giving N D-dimensional data points to
-      classify.
+      classify. X is scored block_size rows at a time, so it can also be an
+      array-like such as a LazyImageArray.
 
     Returns:
     - y_pred: A numpy array of shape (N,) giving predicted labels for each of
@@ -232,10 +229,13 @@ class TwoLayerNet(object):
     # TODO: Implement this function; it should be VERY simple!                #
     ###########################################################################
     #y_pred = np.argmax(self.loss(X), axis=1)
-    a1 = np.dot(X, self.params['W1']) + self.params['b1']
-    a1 = np.maximum(0, a1)
-    a2 = np.dot(a1, self.params['W2']) + self.params['b2']
-    y_pred = np.argmax(a2, axis=1)
+    y_pred = np.zeros(X.shape[0], dtype=np.intp)
+    for start in xrange(0, X.shape[0], block_size):
+      a1 = np.dot(X[start:start + block_size], self.params['W1'])
+      a1 += self.params['b1']
+      a1 = np.maximum(0, a1)
+      a2 = np.dot(a1, self.params['W2']) + self.params['b2']
+      y_pred[start:start + block_size] = np.argmax(a2, axis=1)
 
     ###########################################################################
     #                              END OF YOUR CODE                           #
@@ -1,6 +1,5 @@
 import numpy as np
 from random import shuffle
-from past.builtins import xrange
 
 def softmax_loss_naive(W, X, y, reg):
   """
@@ -66,9 +65,7 @@ def softmax_loss_vectorized(W, X, y, reg):
 
   Inputs and outputs are the same as softmax_loss_naive.
   """
-  # Initialize the loss and gradient to zero.
   loss = 0.0
-  dW = np.zeros_like(W)
 
   #############################################################################
   # TODO: Compute the softmax loss and its gradient using no explicit loops.  #
@@ -76,21 +73,12 @@ def softmax_loss_vectorized(W, X, y, reg):
   # here, it is easy to run into numeric instability. Don't forget the        #
   # regularization!                                                           #
   #############################################################################
-  num_train = X.shape[0]
-  num_classes = W.shape[1]
-
   scores = np.dot(X, W)
-  scores -= np.max(scores, axis=1, keepdims=True)
-  correct_scores = np.sum(scores[range(num_train), y])
-
-  loss = -correct_scores + np.sum(np.log(np.sum(np.exp(scores), axis=1, keepdims=True)))
-  loss = loss / num_train + reg * np.sum(W * W)
+  loss, dscores = softmax_cross_entropy(scores, y, out=scores)
+  loss += reg * np.vdot(W, W)
 
-  prob = np.exp(scores) / np.sum(np.exp(scores), axis=1, keepdims=True)
-  prob[xrange(num_train), y] -= 1
-
-  dW = np.dot(X.T, prob)
-  dW = dW / num_train + 2 * reg * W
+  dW = np.dot(X.T, dscores)
+  dW += 2 * reg * W
 
 
 
@@ -100,3 +88,63 @@ def softmax_loss_vectorized(W, X, y, reg):
 
   return loss, dW
 
+
+def softmax_cross_entropy(scores, y, out=None):
+  """
+  Softmax cross-entropy loss of a matrix of class scores and its gradient
+  with respect to the scores; the data loss of softmax_loss_vectorized and
+  TwoLayerNet.loss.
+
+  The scores are shifted by their row maximum for numerical stability and
+  exponentiated once, in place in the gradient array; the loss only needs
+  the log of the row sums and the shifted scores of the correct classes.
+
+  Inputs:
+  - scores: A numpy array of shape (N, C) of class scores.
+  - y: A numpy array of shape (N,) containing training labels.
+  - out: Optional array of shape (N, C) in which to write the gradient, such
+    as a buffer reused across calls or scores itself when the scores are not
+    needed afterwards.
+
+  Returns a tuple of:
+  - loss, averaged over the N examples, as single float
+  - gradient with respect to scores; an array of same shape as scores
+  """
+  num_train = scores.shape[0]
+  rows = np.arange(num_train)
+  dscores = np.subtract(scores, np.max(scores, axis=1, keepdims=True), out=out)
+  correct_scores = dscores[rows, y]
+  np.exp(dscores, out=dscores)
+  sum_exp = np.sum(dscores, axis=1)
+  loss = (np.sum(np.log(sum_exp)) - np.sum(correct_scores)) / num_train
+  sum_exp *= num_train
+  dscores /= sum_exp[:, np.newaxis]
+  dscores[rows, y] -= 1.0 / num_train
+  return loss, dscores
+
+
+def softmax_loss_stacked(W, X, y, reg):
+  """
+  Softmax loss function of K linear classifiers at once, from one matrix
+  product for the scores and one for the gradients.
+
+  Inputs and outputs are the same as svm_loss_stacked.
+  """
+  num_train = X.shape[0]
+  dim, num_stacked, num_classes = W.shape
+  rows = np.arange(num_train)
+  scores = X.dot(W.reshape(dim, -1)).reshape(num_train, num_stacked,
+                                             num_classes)
+  scores -= np.max(scores, axis=2, keepdims=True)
+  prob = np.exp(scores)
+  sum_exp = np.sum(prob, axis=2, keepdims=True)
+  loss = np.sum(np.log(sum_exp[:, :, 0]) - scores[rows, :, y], axis=0)
+  loss /= num_train
+  loss += reg * np.einsum('dkc,dkc->k', W, W)
+
+  prob /= sum_exp
+  prob[rows, :, y] -= 1
+  dW = X.T.dot(prob.reshape(num_train, -1)).reshape(W.shape)
+  dW /= num_train
+  dW += 2 * reg[:, np.newaxis] * W
+  return loss, dW
@@ -1,12 +1,18 @@
 from __future__ import print_function
 from past.builtins import xrange
 
-import matplotlib
+import functools
+import hashlib
+import multiprocessing
 import numpy as np
+import os
 from scipy.ndimage import uniform_filter
 
+from cs231n.sharedmem import shared_array, shared_copy, shared_view
 
-def extract_features(imgs, feature_fns, verbose=False):
+
+def extract_features(imgs, feature_fns, verbose=False, num_workers=1,
+                     chunk_size=None, cache_dir=None, cache_size=2 ** 30):
   """
   Given pixel data for images and several feature functions that can operate on
   single images, apply all feature functions to all images, concatenating the
@@ -19,6 +25,25 @@ def extract_features(imgs, feature_fns, verbose=False):
     take as input an H x W x D array and return a (one-dimensional) array of
     length F_i.
   - verbose: Boolean; if true, print progress.
+  - num_workers: Number of processes to extract features with; None uses one
+    per CPU. With more than one worker the images are copied into shared
+    memory and each worker fills its chunks of rows of a shared output
+    matrix, running exactly the same per-image code as the serial path, so
+    the result is bitwise identical. Under the 'spawn' start method the
+    feature functions must be picklable.
+  - chunk_size: Number of images per task handed to a worker. Smaller chunks
+    balance the load and report progress more often; larger ones cost less
+    scheduling overhead. Defaults to about four chunks per worker, capped at
+    1000 images.
+  - cache_dir: If given, a directory where extracted features are saved as
+    .npy files. The file name hashes the contents, shape and dtype of imgs
+    together with the code, defaults, closures and global parameters of every
+    feature function, so calling again with the same images and functions
+    memory-maps the saved features (copy-on-write) instead of recomputing
+    them, and changing either one computes new features.
+  - cache_size: Maximum total size in bytes of the feature files in
+    cache_dir. After a new file is written, the least recently used ones are
+    deleted until the cache fits.
 
   Returns:
   An array of shape (N, F_1 + ... + F_k) where each column is the concatenation
@@ -28,6 +53,19 @@ def extract_features(imgs, feature_fns, verbose=False):
   if num_images == 0:
     return np.array([])
 
+  if cache_dir is not None:
+    cache_file = os.path.join(cache_dir, 'features_%s.npy'
+                              % _feature_cache_key(imgs, feature_fns))
+    if os.path.isfile(cache_file):
+      if verbose:
+        print('Loading cached features from %s' % cache_file)
+      os.utime(cache_file, None) # mark as recently used
+      return np.load(cache_file, mmap_mode='c')
+    imgs_features = extract_features(imgs, feature_fns, verbose, num_workers,
+                                     chunk_size)
+    _save_feature_cache(cache_file, imgs_features, cache_size)
+    return imgs_features
+
   # Use the first image to determine feature dimensions
   feature_dims = []
   first_image_features = []
@@ -43,19 +81,190 @@ def extract_features(imgs, feature_fns, verbose=False):
   imgs_features = np.zeros((num_images, total_feature_dim))
   imgs_features[0] = np.hstack(first_image_features).T
 
+  if num_workers is None:
+    num_workers = multiprocessing.cpu_count()
+  if num_workers > 1 and num_images > 1:
+    return _extract_features_parallel(imgs, feature_fns, feature_dims,
+                                      imgs_features, verbose, num_workers,
+                                      chunk_size)
+
   # Extract features for the rest of the images.
   for i in xrange(1, num_images):
-    idx = 0
-    for feature_fn, feature_dim in zip(feature_fns, feature_dims):
-      next_idx = idx + feature_dim
-      imgs_features[i, idx:next_idx] = feature_fn(imgs[i].squeeze())
-      idx = next_idx
+    _extract_image_features(imgs, i, feature_fns, feature_dims, imgs_features)
     if verbose and i % 1000 == 0:
       print('Done extracting features for %d / %d images' % (i, num_images))
 
   return imgs_features
 
 
+def _extract_image_features(imgs, i, feature_fns, feature_dims, imgs_features):
+  idx = 0
+  for feature_fn, feature_dim in zip(feature_fns, feature_dims):
+    next_idx = idx + feature_dim
+    imgs_features[i, idx:next_idx] = feature_fn(imgs[i].squeeze())
+    idx = next_idx
+
+
+def _feature_cache_key(imgs, feature_fns):
+  """ hash the images and feature functions into a cache file name """
+  imgs = np.ascontiguousarray(imgs)
+  sha = hashlib.sha1()
+  sha.update(('%r %s\n' % (imgs.shape, imgs.dtype.str)).encode('utf-8'))
+  sha.update(imgs.reshape(-1).view(np.uint8))
+  seen = set()
+  for feature_fn in feature_fns:
+    sha.update(_feature_fn_key(feature_fn, seen).encode('utf-8'))
+  return sha.hexdigest()
+
+def _feature_fn_key(fn, seen):
+  """
+  Describe a feature function by what it computes rather than by its identity,
+  so the description is the same in every session. Python functions are
+  described by their name, bytecode, constants, defaults and closure, plus the
+  numbers, strings and functions they read from their globals (recursively,
+  so a changed helper or a changed global parameter also changes the key).
+  Partials add their arguments; other callables fall back to their name.
+  """
+  if isinstance(fn, functools.partial):
+    return 'partial(%s, %s, %s)' % (
+      _feature_fn_key(fn.func, seen), _value_key(fn.args, seen),
+      _value_key(sorted((fn.keywords or {}).items()), seen))
+  name = '%s.%s' % (getattr(fn, '__module__', None),
+                    getattr(fn, '__qualname__', getattr(fn, '__name__', fn)))
+  code = getattr(fn, '__code__', None)
+  if code is None or code in seen:
+    return name
+  seen.add(code)
+  parts = [name, _code_key(code),
+           _value_key(fn.__defaults__, seen),
+           _value_key(getattr(fn, '__kwdefaults__', None), seen)]
+  for cell in fn.__closure__ or ():
+    parts.append(_value_key(cell.cell_contents, seen))
+  for global_name in _code_names(code):
+    if global_name in fn.__globals__:
+      value = _value_key(fn.__globals__[global_name], seen)
+      if value is not None:
+        parts.append('%s=%s' % (global_name, value))
+  return '\n'.join(parts)
+
+def _code_key(code):
+  consts = [_code_key(c) if hasattr(c, 'co_code')
+            else _value_key(c, set()) or repr(c) for c in code.co_consts]
+  return '%s(%s)' % (code.co_code.hex() if hasattr(code.co_code, 'hex')
+                     else code.co_code.encode('hex'), ', '.join(consts))
+
+def _code_names(code):
+  names = set(code.co_names)
+  for c in code.co_consts:
+    if hasattr(c, 'co_code'):
+      names.update(_code_names(c))
+  return sorted(names)
+
+def _value_key(value, seen):
+  """ stable description of a parameter value, or None to leave it out """
+  if value is None or isinstance(value, (bool, int, float, complex, str,
+                                         bytes, np.number)):
+    return repr(value)
+  if isinstance(value, (tuple, list)):
+    return '(%s)' % ', '.join(str(_value_key(v, seen)) for v in value)
+  if isinstance(value, (set, frozenset)):
+    return '{%s}' % ', '.join(sorted(str(_value_key(v, seen)) for v in value))
+  if isinstance(value, dict):
+    return '{%s}' % ', '.join(sorted('%s: %s' % (_value_key(k, seen),
+                                                 _value_key(v, seen))
+                                     for k, v in value.items()))
+  if isinstance(value, np.ndarray):
+    return 'array(%r, %s, %s)' % (
+      value.shape, value.dtype.str,
+      hashlib.sha1(np.ascontiguousarray(value).reshape(-1).view(np.uint8))
+      .hexdigest())
+  if callable(value) and not isinstance(value, type):
+    return _feature_fn_key(value, seen)
+  return None
+
+def _save_feature_cache(cache_file, imgs_features, cache_size):
+  """ atomically write a cache entry, then evict least recently used ones """
+  cache_dir = os.path.dirname(cache_file)
+  if cache_dir and not os.path.isdir(cache_dir):
+    os.makedirs(cache_dir)
+  # the temporary name is per process, so concurrent writers of the same
+  # entry do not write into one file
+  tmp_filename = '%s.%d.tmp' % (cache_file, os.getpid())
+  with open(tmp_filename, 'wb') as f:
+    np.save(f, imgs_features)
+  os.replace(tmp_filename, cache_file)
+
+  entries = []
+  for name in os.listdir(cache_dir or '.'):
+    if name.startswith('features_') and name.endswith('.npy'):
+      filename = os.path.join(cache_dir, name)
+      st = os.stat(filename)
+      entries.append((st.st_mtime, st.st_size, filename))
+  total_size = sum(size for _, size, _ in entries)
+  for _, size, filename in sorted(entries):
+    if total_size <= cache_size:
+      break
+    if filename != cache_file:
+      os.remove(filename)
+      total_size -= size
+
+
+# Shared state of the worker processes used by extract_features; filled in
+# by _init_extract_worker when each worker starts.
+_extract_shared = {}
+
+def _init_extract_worker(imgs_buf, imgs_shape, imgs_dtype, out_buf, out_shape,
+                         feature_fns, feature_dims):
+  _extract_shared['imgs'] = shared_view(imgs_buf, imgs_shape, imgs_dtype)
+  _extract_shared['out'] = shared_view(out_buf, out_shape, np.float64)
+  _extract_shared['feature_fns'] = feature_fns
+  _extract_shared['feature_dims'] = feature_dims
+
+def _extract_features_chunk(chunk):
+  start, stop = chunk
+  for i in xrange(start, stop):
+    _extract_image_features(_extract_shared['imgs'], i,
+                            _extract_shared['feature_fns'],
+                            _extract_shared['feature_dims'],
+                            _extract_shared['out'])
+  return stop - start
+
+
+def _extract_features_parallel(imgs, feature_fns, feature_dims, imgs_features,
+                               verbose, num_workers, chunk_size):
+  """
+  Parallel path of extract_features. Only the first row of imgs_features is
+  filled in; it was computed to find the feature dimensions.
+  """
+  num_images = imgs.shape[0]
+  if chunk_size is None:
+    chunk_size = -(-num_images // (4 * num_workers))
+    chunk_size = max(1, min(chunk_size, 1000))
+
+  imgs_buf = shared_copy(imgs)[0]
+  out_buf, shared_features = shared_array(imgs_features.shape, np.float64)
+  shared_features[0] = imgs_features[0]
+
+  chunks = [(start, min(start + chunk_size, num_images))
+            for start in xrange(1, num_images, chunk_size)]
+  pool = multiprocessing.Pool(num_workers, _init_extract_worker,
+                              (imgs_buf, imgs.shape, imgs.dtype, out_buf,
+                               shared_features.shape, feature_fns,
+                               feature_dims))
+  try:
+    num_done = 1
+    for count in pool.imap_unordered(_extract_features_chunk, chunks):
+      num_done += count
+      if verbose and num_done // 1000 != (num_done - count) // 1000:
+        print('Done extracting features for %d / %d images'
+              % (num_done, num_images))
+  finally:
+    pool.close()
+    pool.join()
+
+  return shared_features
+
+
 def rgb2gray(rgb):
   """Convert RGB image to grayscale
 
@@ -123,6 +332,99 @@ def hog_feature(im):
   return orientation_histogram.ravel()
 
 
+def hog_feature_batch(imgs, batch_size=None):
+  """Compute HOG features for a batch of images in one vectorized pass
+
+    Computes the same features as calling hog_feature on every image (up to
+    floating point rounding), but the gradients and orientations of a whole
+    batch are computed at once, the orientation bin of every pixel is found
+    with a single floor division, and the magnitudes are summed into their
+    (cell, bin) slots with a single np.bincount instead of one uniform_filter
+    per bin.
+
+    Parameters:
+      imgs : N x H x W x C array of rgb images or N x H x W array of grayscale
+        images
+      batch_size : number of images processed at a time, which bounds the
+        size of the N x H x W temporaries; None keeps each one near 1 MB so
+        that they stay in cache
+
+    Returns:
+      feat: N x F array where feat[i] is the HOG feature of imgs[i]
+
+  """
+  num_images = imgs.shape[0]
+  sx, sy = imgs.shape[1:3] # image size
+  orientations = 9 # number of gradient bins
+  cx, cy = (8, 8) # pixels per cell
+  if batch_size is None:
+    batch_size = max(1, 2 ** 20 // (8 * sx * sy))
+
+  n_cellsx = int(np.floor(sx / cx))  # number of cells in x
+  n_cellsy = int(np.floor(sy / cy))  # number of cells in y
+  num_cells = n_cellsx * n_cellsy
+  # hog_feature averages each cell with uniform_filter, which only sees the
+  # pixels of whole cells
+  hx, hy = n_cellsx * cx, n_cellsy * cy
+  bin_width = 180 / orientations
+  # Orientations lie in [-90, 270]; every cell gets a slot per bin of width
+  # bin_width over that range, and only the slots of [0, 180) are kept.
+  first_bin = int(np.ceil(90 / bin_width))
+  num_slots = int(270 // bin_width) + first_bin + 1
+  # hog_feature transposes each orientation image, so the cells are stored
+  # column-major
+  cell_ids = (np.arange(hx) // cx)[:, None] + \
+             n_cellsx * (np.arange(hy) // cy)[None, :]
+
+  feats = np.zeros((num_images, num_cells * orientations))
+  for start in range(0, num_images, batch_size):
+    batch = imgs[start:start + batch_size]
+    n = batch.shape[0]
+
+    # convert rgb to grayscale if needed
+    if batch.ndim == 4:
+      image = rgb2gray(batch)
+    else:
+      image = np.asarray(batch, dtype=np.float64)
+
+    gx = np.zeros(image.shape)
+    gy = np.zeros(image.shape)
+    # compute gradient on x-direction
+    np.subtract(image[:, :, 1:], image[:, :, :-1], out=gx[:, :, :-1])
+    # compute gradient on y-direction
+    np.subtract(image[:, 1:, :], image[:, :-1, :], out=gy[:, :-1, :])
+    gx, gy = gx[:, :hx, :hy], gy[:, :hx, :hy]
+    # gradient magnitude
+    grad_mag = gx * gx
+    grad_mag += gy * gy
+    np.sqrt(grad_mag, out=grad_mag)
+    # gradient orientation, computed in place over gy
+    gx += 1e-15
+    grad_ori = np.arctan2(gy, gx, out=gy)
+    grad_ori *= 180 / np.pi
+    grad_ori += 90
+
+    # Dividing can round an orientation just below a bin edge up onto it, so
+    # compare against the exact edges to get the same bins as hog_feature.
+    ori_bin = grad_ori / bin_width
+    np.floor(ori_bin, out=ori_bin)
+    ori_bin -= grad_ori < ori_bin * bin_width
+    ori_bin += first_bin
+    # hog_feature also leaves out orientations of exactly 0
+    ori_bin[grad_ori == 0] = 0
+
+    slots = np.arange(n)[:, None, None] * num_cells + cell_ids
+    slots *= num_slots
+    slots = slots + ori_bin.astype(np.intp)
+    hist = np.bincount(slots.ravel(), weights=grad_mag.ravel(),
+                       minlength=n * num_cells * num_slots)
+    hist = hist.reshape(n, num_cells, num_slots)
+    hist = hist[:, :, first_bin:first_bin + orientations]
+    feats[start:start + n] = hist.reshape(n, -1) / (cx * cy)
+
+  return feats
+
+
 def color_histogram_hsv(im, nbin=10, xmin=0, xmax=255, normalized=True):
   """
   Compute color histogram for an image using hue.
@@ -138,9 +440,10 @@ def color_histogram_hsv(im, nbin=10, xmin=0, xmax=255, normalized=True):
     1D vector of length nbin giving the color histogram over the hue of the
     input image.
   """
+  from matplotlib.colors import rgb_to_hsv
   ndim = im.ndim
   bins = np.linspace(xmin, xmax, nbin+1)
-  hsv = matplotlib.colors.rgb_to_hsv(im/xmax) * xmax
+  hsv = rgb_to_hsv(im/xmax) * xmax
   imhist, bin_edges = np.histogram(hsv[:,:,0], bins=bins, density=normalized)
   imhist = imhist * np.diff(bin_edges)
 
@@ -148,4 +451,71 @@ def color_histogram_hsv(im, nbin=10, xmin=0, xmax=255, normalized=True):
   return imhist
 
 
+def color_histogram_hsv_batch(imgs, nbin=10, xmin=0, xmax=255, normalized=True,
+                              batch_size=1000):
+  """
+  Compute hue color histograms for a batch of images without matplotlib.
+
+  Gives the same histograms as calling color_histogram_hsv on every image, but
+  the hue of all pixels in a batch is computed at once with the same formulas
+  as matplotlib.colors.rgb_to_hsv, and all histograms of the batch are counted
+  with a single np.bincount over per-image offset bin indices.
+
+  Inputs:
+  - imgs: N x H x W x C array of pixel data for N RGB images.
+  - nbin: Number of histogram bins. (default: 10)
+  - xmin: Minimum pixel value (default: 0)
+  - xmax: Maximum pixel value (default: 255)
+  - normalized: Whether to normalize the histogram (default: True)
+  - batch_size: Number of images processed at a time, which bounds the size
+    of the N x H x W temporaries. (default: 1000)
+
+  Returns:
+    N x nbin array whose ith row is the color histogram over the hue of the
+    ith image.
+  """
+  num_images = imgs.shape[0]
+  bins = np.linspace(xmin, xmax, nbin+1)
+  bin_widths = np.diff(bins)
+  imhist = np.zeros((num_images, nbin))
+  for start in range(0, num_images, batch_size):
+    rgb = imgs[start:start + batch_size] / xmax
+    n = rgb.shape[0]
+    r, g, b = rgb[..., 0], rgb[..., 1], rgb[..., 2]
+
+    # hue of each pixel, following matplotlib.colors.rgb_to_hsv: the sector
+    # of the largest channel decides the offset, and blue wins ties over
+    # green, which wins over red. Gray pixels have a hue of 0.
+    arr_max = np.maximum(np.maximum(r, g), b)
+    delta = arr_max - np.minimum(np.minimum(r, g), b)
+    gray = delta == 0
+    delta[gray] = 1
+    blue_max = b == arr_max
+    green_max = (g == arr_max) & ~blue_max
+    hue = np.where(blue_max, r - g, np.where(green_max, b - r, g - b))
+    hue /= delta
+    hue += np.where(blue_max, 4., np.where(green_max, 2., 0.))
+    hue[gray] = 0
+    # hue / 6 lies in (-1, 1), where % 1.0 only adds 1 to negative values
+    hue /= 6.0
+    hue[hue < 0] += 1.0
+    hue *= xmax
+
+    # Bins are half-open except the last one, which also holds xmax, like
+    # np.histogram; values outside [xmin, xmax] are not counted.
+    idx = np.searchsorted(bins, hue, side='right') - 1
+    idx[hue == bins[-1]] = nbin - 1
+    keep = (idx >= 0) & (idx < nbin)
+    idx += np.arange(n).reshape((n,) + (1,) * (idx.ndim - 1)) * nbin
+    counts = np.bincount(idx[keep], minlength=n * nbin).reshape(n, nbin)
+
+    if normalized:
+      hist = counts / bin_widths / counts.sum(1, keepdims=True)
+    else:
+      hist = counts
+    imhist[start:start + n] = hist * bin_widths
+
+  return imhist
+
+
 pass
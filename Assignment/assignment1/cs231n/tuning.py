@@ -0,0 +1,319 @@
+from __future__ import print_function
+from past.builtins import xrange
+
+import json
+import multiprocessing
+import numpy as np
+import os
+import time
+from six.moves import queue
+
+from cs231n.classifiers.neural_net import TwoLayerNet
+from cs231n.sharedmem import shared_array, shared_view
+
+
+def search(trial, data, param_space, num_trials, max_budget,
+           schedule='random', min_budget=None, eta=3, num_workers=None,
+           log_file=None, seed=0, verbose=False):
+  """
+  Search for good hyperparameters by training many trials on a pool of worker
+  processes.
+
+  The arrays of data are copied once into shared memory that every worker
+  reads, and each trial is a set of hyperparameters drawn from param_space.
+  With schedule='random' every trial is trained for max_budget. With
+  schedule='halving' trials are trained with asynchronous successive halving
+  (ASHA): they all start with min_budget, and whenever a worker is free the
+  best 1/eta of the trials that reached a budget, by score, are trained on to
+  eta times that budget (up to max_budget), picking up from where they
+  stopped. The other trials are never trained further, so hopeless
+  hyperparameters only cost min_budget each.
+
+  Every finished run is appended to log_file as one line of JSON. Calling
+  search again with the same log_file resumes the search: the runs in the log
+  are not repeated, though trials promoted after a restart are trained again
+  from scratch as their models are not logged.
+
+  Inputs:
+  - trial: A picklable callable trial(params, data, budget, state) that
+    trains a model with the hyperparameters in the dict params for budget
+    more units (iterations or epochs, say) and returns a tuple (score,
+    state), where score is the validation accuracy and state the trained
+    model; state is None for a new model. See LinearClassifierTrial and
+    TwoLayerNetTrial.
+  - data: A dictionary of numpy arrays passed to every trial, such as
+    'X_train', 'y_train', 'X_val' and 'y_val'.
+  - param_space: A dictionary mapping each hyperparameter name to a list of
+    values, one of which is picked uniformly at random, or to an object with
+    a sample(rng) method such as LogUniform.
+  - num_trials: Number of hyperparameter settings to try.
+  - max_budget: Budget of a fully trained trial.
+  - schedule: 'random' or 'halving'.
+  - min_budget: First budget of the 'halving' schedule; defaults to
+    max_budget / eta ** 3.
+  - eta: Fraction of the trials promoted to the next budget, and the factor
+    by which the budget grows.
+  - num_workers: Number of processes; None uses one per CPU.
+  - log_file: Path of the JSON lines log, or None for no log.
+  - seed: Seed of the random hyperparameters; trials also seed np.random
+    with it and their trial number.
+  - verbose: If true, print every finished run.
+
+  Returns a tuple of:
+  - results: A list with a dictionary for each trial that was run, describing
+    its last run: 'trial' (its number), 'params', 'budget', 'score' and
+    'seconds'. Trials trained with larger budgets come first, and equal
+    budgets are ordered by decreasing score.
+  - best: The state returned for the first trial in results, or None if that
+    run was read from the log.
+  """
+  if schedule == 'random':
+    budgets = [max_budget]
+  elif schedule == 'halving':
+    if min_budget is None:
+      min_budget = max(1, int(max_budget // eta ** 3))
+    budgets = []
+    budget = min_budget
+    while budget < max_budget:
+      budgets.append(budget)
+      budget *= eta
+    budgets.append(max_budget)
+  else:
+    raise ValueError('Invalid schedule "%s"' % schedule)
+  if num_workers is None:
+    num_workers = multiprocessing.cpu_count()
+
+  rng = np.random.RandomState(seed)
+  trial_params = [_sample_params(param_space, rng) for i in xrange(num_trials)]
+  # scores[k] maps the trials that finished budget k to their scores, and
+  # promoted[k] holds the ones that were sent on to budget k + 1
+  scores = [{} for budget in budgets]
+  promoted = [set() for budget in budgets]
+  results = {}
+  if log_file is not None and os.path.exists(log_file):
+    for record in _read_search_log(log_file):
+      rung = record['rung']
+      if rung >= len(budgets) or record['budget'] != budgets[rung]:
+        raise ValueError('Log "%s" was written with other budgets' % log_file)
+      trial_id = record['trial']
+      while trial_id >= len(trial_params):
+        trial_params.append(None)
+      trial_params[trial_id] = record['params']
+      scores[rung][trial_id] = record['score']
+      if rung > 0:
+        promoted[rung - 1].add(trial_id)
+      if results.get(trial_id, {'rung': -1})['rung'] < rung:
+        results[trial_id] = record
+  fresh = [i for i in xrange(num_trials) if i not in scores[0]]
+  fresh.reverse()
+  states = {}
+
+  def next_task():
+    # promote from the highest budget first, then start new trials
+    for rung in xrange(len(budgets) - 2, -1, -1):
+      rung_scores = scores[rung]
+      num_top = len(rung_scores) // eta
+      top = sorted(rung_scores, key=lambda i: (-rung_scores[i], i))[:num_top]
+      for trial_id in top:
+        if trial_id not in promoted[rung]:
+          promoted[rung].add(trial_id)
+          state, done = states.pop(trial_id, (None, 0))
+          return (trial_id, rung + 1, trial_params[trial_id],
+                  budgets[rung + 1] - done, state, seed)
+    if fresh:
+      trial_id = fresh.pop()
+      return trial_id, 0, trial_params[trial_id], budgets[0], None, seed
+    return None
+
+  buffers = {}
+  for name, value in data.items():
+    value = np.asarray(value)
+    buf, shared = shared_array(value.shape, value.dtype)
+    shared[...] = value
+    buffers[name] = (buf, value.shape, value.dtype)
+
+  best, best_key = None, None
+  log = open(log_file, 'a') if log_file is not None else None
+  pool = multiprocessing.Pool(num_workers, _init_search_worker,
+                              (buffers, trial))
+  done = queue.Queue()
+  try:
+    num_running = 0
+    while True:
+      while num_running < num_workers:
+        task = next_task()
+        if task is None:
+          break
+        # errors the task cannot return itself, such as a result that does
+        # not pickle, come through error_callback
+        pool.apply_async(_run_search_task, (task,), callback=done.put,
+                         error_callback=done.put)
+        num_running += 1
+      if num_running == 0:
+        break
+      result = done.get()
+      num_running -= 1
+      if isinstance(result, BaseException):
+        raise result
+      trial_id, rung, score, state, seconds = result
+      scores[rung][trial_id] = score
+      if rung < len(budgets) - 1:
+        states[trial_id] = (state, budgets[rung])
+      key = (budgets[rung], score, -trial_id)
+      if best_key is None or key > best_key:
+        best, best_key = state, key
+      record = {'trial': trial_id, 'rung': rung, 'budget': budgets[rung],
+                'params': trial_params[trial_id], 'score': score,
+                'seconds': seconds}
+      results[trial_id] = record
+      if log is not None:
+        log.write(json.dumps(record, sort_keys=True) + '\n')
+        log.flush()
+      if verbose:
+        print('trial %d budget %s: score %f (%.1fs)'
+              % (trial_id, budgets[rung], score, seconds))
+  finally:
+    pool.close()
+    pool.join()
+    if log is not None:
+      log.close()
+
+  results = sorted(results.values(),
+                   key=lambda r: (-r['budget'], -r['score'], r['trial']))
+  for record in results:
+    del record['rung']
+  if not results or best_key != (results[0]['budget'], results[0]['score'],
+                                 -results[0]['trial']):
+    best = None
+  return results, best
+
+
+class LogUniform(object):
+  """
+  A hyperparameter for search whose logarithm is uniform between those of
+  low and high, as suits learning rates and regularization strengths.
+  """
+
+  def __init__(self, low, high):
+    self.low = low
+    self.high = high
+
+  def sample(self, rng):
+    return float(np.exp(rng.uniform(np.log(self.low), np.log(self.high))))
+
+
+class LinearClassifierTrial(object):
+  """
+  Trial for search that trains a LinearClassifier subclass, such as LinearSVM
+  or Softmax, with its train method; budgets are numbers of iterations and
+  the score is the validation accuracy. The params of a trial are passed to
+  train as keyword arguments, after those given here.
+  """
+
+  def __init__(self, classifier_class, **train_kwargs):
+    self.classifier_class = classifier_class
+    self.train_kwargs = train_kwargs
+
+  def __call__(self, params, data, budget, state):
+    classifier = state
+    if classifier is None:
+      classifier = self.classifier_class()
+    kwargs = dict(self.train_kwargs)
+    kwargs.update(params)
+    classifier.train(data['X_train'], data['y_train'], num_iters=budget,
+                     **kwargs)
+    val_acc = np.mean(classifier.predict(data['X_val']) == data['y_val'])
+    return val_acc, classifier
+
+
+class TwoLayerNetTrial(object):
+  """
+  Trial for search that trains a TwoLayerNet with its train method; budgets
+  are numbers of epochs and the score is the validation accuracy. The params
+  'hidden_size' and 'std' are used to build the network and the others are
+  passed to train, after the train_kwargs given here. A network trained on
+  continues with the learning rate decayed for the epochs it already had.
+  """
+
+  def __init__(self, input_size, output_size, hidden_size=50, std=1e-4,
+               **train_kwargs):
+    self.input_size = input_size
+    self.output_size = output_size
+    self.hidden_size = hidden_size
+    self.std = std
+    self.train_kwargs = train_kwargs
+
+  def __call__(self, params, data, budget, state):
+    kwargs = {'learning_rate': 1e-3, 'learning_rate_decay': 0.95,
+              'batch_size': 200}
+    kwargs.update(self.train_kwargs)
+    kwargs.update(params)
+    hidden_size = kwargs.pop('hidden_size', self.hidden_size)
+    std = kwargs.pop('std', self.std)
+    if state is None:
+      net, epochs_done = TwoLayerNet(self.input_size, hidden_size,
+                                     self.output_size, std), 0
+    else:
+      net, epochs_done = state
+    kwargs['learning_rate'] *= kwargs['learning_rate_decay'] ** epochs_done
+    num_train = data['X_train'].shape[0]
+    kwargs['num_iters'] = int(round(budget * num_train
+                                    / float(kwargs['batch_size'])))
+    net.train(data['X_train'], data['y_train'], data['X_val'], data['y_val'],
+              **kwargs)
+    val_acc = np.mean(net.predict(data['X_val']) == data['y_val'])
+    return val_acc, (net, epochs_done + budget)
+
+
+def _sample_params(param_space, rng):
+  params = {}
+  for name in sorted(param_space):
+    space = param_space[name]
+    if hasattr(space, 'sample'):
+      value = space.sample(rng)
+    else:
+      value = space[rng.randint(len(space))]
+    if isinstance(value, np.generic):
+      # keep the params JSON serializable
+      value = value.item()
+    params[name] = value
+  return params
+
+
+def _read_search_log(log_file):
+  """ the records of a search log, skipping a last line cut off by a crash """
+  records = []
+  with open(log_file) as f:
+    for line in f:
+      try:
+        records.append(json.loads(line))
+      except ValueError:
+        pass
+  return records
+
+
+# Shared state of the worker processes used by search; filled in by
+# _init_search_worker when each worker starts.
+_search_shared = {}
+
+def _init_search_worker(buffers, trial):
+  data = {}
+  for name, (buf, shape, dtype) in buffers.items():
+    data[name] = shared_view(buf, shape, dtype)
+  _search_shared['data'] = data
+  _search_shared['trial'] = trial
+
+def _run_search_task(task):
+  """
+  Train one trial for one budget; returns the result for search, or the
+  exception the trial raised.
+  """
+  trial_id, rung, params, budget, state, seed = task
+  np.random.seed([seed, trial_id, rung])
+  start = time.time()
+  try:
+    score, state = _search_shared['trial'](params, _search_shared['data'],
+                                           budget, state)
+  except BaseException as e:
+    return e
+  return trial_id, rung, float(score), state, time.time() - start
@@ -0,0 +1,20 @@
+import numpy as np
+
+
+def workspace_array(workspace, name, shape, dtype):
+  """
+  Return an uninitialized array of the given shape and dtype, made from the
+  buffer workspace[name] when that is large enough; a larger buffer replaces
+  it otherwise. Without a workspace a new array is allocated.
+
+  This lets functions that take an optional workspace dict, such as
+  KNearestNeighbor.kneighbors and svm_loss_vectorized, reuse their buffers
+  across calls.
+  """
+  if workspace is None:
+    return np.empty(shape, dtype=dtype)
+  size = int(np.prod(shape))
+  buf = workspace.get(name)
+  if buf is None or buf.dtype != dtype or buf.size < size:
+    buf = workspace[name] = np.empty(size, dtype=dtype)
+  return buf[:size].reshape(shape)
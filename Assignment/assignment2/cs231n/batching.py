@@ -0,0 +1,195 @@
+from __future__ import print_function, division
+from builtins import range
+from builtins import object
+import threading
+
+import numpy as np
+from six.moves import queue
+
+"""
+This file implements the minibatch samplers used by Solver, and a prefetcher
+that gathers upcoming minibatches on a background thread while the model
+computes the loss on the current one.
+
+A sampler is any iterable that yields, forever, the training indices of one
+minibatch at a time: either an integer index array or a slice. Solver accepts
+a sampler object directly, or the name of one of the SAMPLERS below.
+
+The samplers below draw from their own np.random.RandomState rather than the
+global one, since with prefetching they run on a background thread, where
+sharing the global generator with the model (dropout, say) would make the
+draws of both depend on thread timing. Without a seed, the seed is taken from
+the global generator when the sampler is made, so np.random.seed still makes
+a run reproducible.
+"""
+
+
+def _sampler_rng(seed):
+    if seed is None:
+        seed = np.random.randint(2 ** 31)
+    return np.random.RandomState(seed)
+
+
+class RandomBatchSampler(object):
+    """
+    Draws every minibatch independently with RandomState.choice, so examples
+    are sampled with replacement. This is Solver's default behavior.
+    """
+
+    def __init__(self, num_train, batch_size, seed=None):
+        self.num_train = num_train
+        self.batch_size = batch_size
+        self.rng = _sampler_rng(seed)
+
+    def __iter__(self):
+        while True:
+            yield self.rng.choice(self.num_train, self.batch_size)
+
+
+class EpochBatchSampler(object):
+    """
+    Shuffles the training set once per epoch and then walks through the
+    permutation batch_size examples at a time, so every example is used once
+    per epoch; the last partial batch of an epoch is dropped. The indices of
+    each batch are sorted to make the gather more cache friendly. With
+    shuffle=False the batches are contiguous slices, which index without a
+    copy.
+    """
+
+    def __init__(self, num_train, batch_size, shuffle=True, seed=None):
+        if batch_size > num_train:
+            raise ValueError('batch_size %d is larger than the %d training '
+                             'examples' % (batch_size, num_train))
+        self.num_train = num_train
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.rng = _sampler_rng(seed)
+
+    def __iter__(self):
+        last_start = self.num_train - self.batch_size
+        while True:
+            if not self.shuffle:
+                for start in range(0, last_start + 1, self.batch_size):
+                    yield slice(start, start + self.batch_size)
+                continue
+            order = self.rng.permutation(self.num_train)
+            for start in range(0, last_start + 1, self.batch_size):
+                yield np.sort(order[start:start + self.batch_size])
+
+
+SAMPLERS = {
+    'random': RandomBatchSampler,
+    'epoch': EpochBatchSampler,
+}
+
+
+class BatchGatherer(object):
+    """
+    Gathers minibatches X[idx], y[idx] into a ring of preallocated buffers
+    with np.take(..., out=...), so a training loop does not allocate new
+    arrays (and fault in fresh pages) on every iteration.
+
+    The batch returned by gather() lives in one of num_buffers slots and is
+    overwritten num_buffers calls later, so callers must be done with it (or
+    copy it) by then. Slices are returned as views, and data that is not an
+    ndarray (such as a LazyImageArray) is indexed normally.
+    """
+
+    def __init__(self, X, y, num_buffers=1):
+        self.X = X
+        self.y = y
+        self.num_buffers = num_buffers
+        self._buffers = [None] * num_buffers
+        self._next = 0
+
+    def gather(self, idx):
+        if isinstance(idx, slice) or not isinstance(self.X, np.ndarray):
+            return self.X[idx], self.y[idx]
+        idx = np.asarray(idx)
+        if idx.size and (idx.min() < 0 or idx.max() >= len(self.X)):
+            # negative indices, or ones that should raise IndexError
+            return self.X[idx], self.y[idx]
+        slot = self._next
+        self._next = (slot + 1) % self.num_buffers
+        buffers = self._buffers[slot]
+        if buffers is None or buffers[1].shape != idx.shape:
+            X_shape = idx.shape + self.X.shape[1:]
+            buffers = (np.empty(X_shape, dtype=self.X.dtype),
+                       np.empty(idx.shape, dtype=self.y.dtype))
+            self._buffers[slot] = buffers
+        X_buf, y_buf = buffers
+        # np.take always buffers its output when mode='raise'; the indices
+        # were checked to be in range above, so 'clip' is safe and lets it
+        # write straight into out.
+        np.take(self.X, idx, axis=0, out=X_buf, mode='clip')
+        np.take(self.y, idx, axis=0, out=y_buf, mode='clip')
+        return X_buf, y_buf
+
+
+def iterate_minibatches(X, y, sampler):
+    """
+    Yield (X_batch, y_batch) tuples for the indices produced by sampler,
+    gathering each minibatch on the calling thread into a reused buffer that
+    is only valid until the next batch is requested.
+    """
+    gatherer = BatchGatherer(X, y)
+    for idx in sampler:
+        yield gatherer.gather(idx)
+
+
+class BatchPrefetcher(object):
+    """
+    Iterator over (X_batch, y_batch) tuples that gathers the minibatches
+    chosen by a sampler on a background thread, keeping up to `prefetch`
+    batches ready ahead of the consumer.
+
+    Batches are gathered by a BatchGatherer whose ring holds prefetch + 2
+    buffers: the queued batches, the one being gathered and the one the
+    consumer holds. A batch returned by next() is therefore only valid until
+    the following call to next(); copy it if it has to outlive that.
+
+    Call close() when done to stop the background thread.
+    """
+
+    def __init__(self, X, y, sampler, prefetch=2):
+        if prefetch < 1:
+            raise ValueError('prefetch must be at least 1, got %d' % prefetch)
+        self.sampler = sampler
+        self._gatherer = BatchGatherer(X, y, num_buffers=prefetch + 2)
+        self._queue = queue.Queue(maxsize=prefetch)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _put(self, item):
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _run(self):
+        try:
+            for idx in self.sampler:
+                if not self._put(self._gatherer.gather(idx)):
+                    return
+        except Exception as e:
+            self._put(e)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        item = self._queue.get()
+        if isinstance(item, Exception):
+            raise item
+        return item
+
+    next = __next__
+
+    def close(self):
+        self._stop.set()
+        self._thread.join()
@@ -102,7 +102,7 @@ class TwoLayerNet(object):
         # automated tests, make sure that your L2 regularization includes a factor #
         # of 0.5 to simplify the expression for the gradient.                      #
         ############################################################################
-        loss, dscores = softmax_loss(scores, y)
+        loss, dscores = softmax_loss(scores, y, out=scores)
         loss += 0.5 * self.reg * np.sum(np.square(self.params['W1'])) + 0.5 * self.reg * np.sum(np.square(self.params['W2']))
         d1_out, dw2, db2, = affine_backward(dscores, layer2_cache)
         grads['W2'] = dw2 + self.reg * self.params['W2']
@@ -297,7 +297,7 @@ class FullyConnectedNet(object):
         ############################################################################
         
         # loss的正则化还是要先做完啊
-        loss, dsoft = softmax_loss(scores, y)
+        loss, dsoft = softmax_loss(scores, y, out=scores)
         loss += 0.5 * self.reg * np.sum(np.square(self.params['W'+str(self.num_layers)]))
 
         # 先从最后一层开始算起
@@ -2,11 +2,17 @@ from __future__ import print_function
 
 from builtins import range
 from six.moves import cPickle as pickle
+import collections
+import hashlib
+import json
+import multiprocessing
 import numpy as np
 import os
 from scipy.misc import imread
 import platform
 
+from cs231n.sharedmem import shared_array, shared_view
+
 def load_pickle(f):
     version = platform.python_version_tuple()
     if version[0] == '2':
@@ -15,18 +21,106 @@ def load_pickle(f):
         return  pickle.load(f, encoding='latin1')
     raise ValueError("invalid python version: {}".format(version))
 
-def load_CIFAR_batch(filename):
+def load_CIFAR_batch(filename, dtype="float"):
     """ load single batch of cifar """
     with open(filename, 'rb') as f:
         datadict = load_pickle(f)
         X = datadict['data']
         Y = datadict['labels']
-        X = X.reshape(10000, 3, 32, 32).transpose(0,2,3,1).astype("float")
+        X = X.reshape(10000, 3, 32, 32).transpose(0,2,3,1).astype(dtype)
         Y = np.array(Y)
         return X, Y
 
-def load_CIFAR10(ROOT):
-    """ load all of cifar """
+# Layout of the packed CIFAR-10 cache written by convert_CIFAR10: a fixed-size
+# header (magic, num_train, num_test) followed by the raw uint8 training
+# images, test images, training labels and test labels, back to back.
+CIFAR10_CACHE_FILE = 'cifar10_uint8.bin'
+CIFAR10_CACHE_MAGIC = b'C10CACHE'
+CIFAR10_CACHE_HEADER = 64
+
+def convert_CIFAR10(ROOT, filename=None):
+    """
+    Convert the pickled CIFAR-10 batches in ROOT into a single packed uint8
+    file that can be memory-mapped by load_CIFAR10(ROOT, mmap=True). This only
+    needs to run once; the file is written under a temporary name and renamed
+    into place so concurrent readers never see a partial cache.
+
+    Inputs:
+    - ROOT: Directory containing the cifar-10-batches-py files.
+    - filename: Path of the cache file; defaults to CIFAR10_CACHE_FILE in ROOT.
+
+    Returns:
+    The path of the cache file.
+    """
+    if filename is None:
+        filename = os.path.join(ROOT, CIFAR10_CACHE_FILE)
+    xs = []
+    ys = []
+    for b in range(1,6):
+        X, Y = load_CIFAR_batch(os.path.join(ROOT, 'data_batch_%d' % (b, )),
+                                dtype=np.uint8)
+        xs.append(X)
+        ys.append(Y)
+    Xte, Yte = load_CIFAR_batch(os.path.join(ROOT, 'test_batch'),
+                                dtype=np.uint8)
+    num_train = sum(X.shape[0] for X in xs)
+
+    header = np.zeros(CIFAR10_CACHE_HEADER, dtype=np.uint8)
+    header[:8] = np.frombuffer(CIFAR10_CACHE_MAGIC, dtype=np.uint8)
+    header[8:16].view(np.uint32)[:] = [num_train, Xte.shape[0]]
+
+    tmp_filename = '%s.%d.tmp' % (filename, os.getpid())
+    with open(tmp_filename, 'wb') as f:
+        f.write(header.tobytes())
+        for X in xs:
+            f.write(np.ascontiguousarray(X).tobytes())
+        f.write(np.ascontiguousarray(Xte).tobytes())
+        for Y in ys:
+            f.write(Y.astype(np.uint8).tobytes())
+        f.write(Yte.astype(np.uint8).tobytes())
+    os.rename(tmp_filename, filename)
+    return filename
+
+def load_CIFAR10_cache(filename):
+    """
+    Memory-map a cache file written by convert_CIFAR10. The images are
+    returned as read-only uint8 arrays of shape (N, 32, 32, 3) backed by the
+    page cache, so any number of processes can share a single copy; the labels
+    are small and are copied into int64 arrays.
+    """
+    with open(filename, 'rb') as f:
+        header = np.frombuffer(f.read(CIFAR10_CACHE_HEADER), dtype=np.uint8)
+    if header[:8].tobytes() != CIFAR10_CACHE_MAGIC:
+        raise ValueError('%s is not a CIFAR-10 cache file' % filename)
+    num_train, num_test = [int(n) for n in header[8:16].view(np.uint32)]
+
+    offset = CIFAR10_CACHE_HEADER
+    image_size = 32 * 32 * 3
+    Xtr = np.memmap(filename, dtype=np.uint8, mode='r', offset=offset,
+                    shape=(num_train, 32, 32, 3))
+    offset += num_train * image_size
+    Xte = np.memmap(filename, dtype=np.uint8, mode='r', offset=offset,
+                    shape=(num_test, 32, 32, 3))
+    offset += num_test * image_size
+    labels = np.memmap(filename, dtype=np.uint8, mode='r', offset=offset,
+                       shape=(num_train + num_test,))
+    Ytr = np.array(labels[:num_train], dtype=np.int64)
+    Yte = np.array(labels[num_train:], dtype=np.int64)
+    return Xtr, Ytr, Xte, Yte
+
+def load_CIFAR10(ROOT, mmap=False):
+    """
+    load all of cifar
+
+    With mmap=True the images come from the packed uint8 cache in ROOT
+    (created on first use by convert_CIFAR10) and are returned as read-only
+    memory-mapped uint8 arrays instead of freshly unpickled float64 copies.
+    """
+    if mmap:
+        filename = os.path.join(ROOT, CIFAR10_CACHE_FILE)
+        if not os.path.isfile(filename):
+            convert_CIFAR10(ROOT, filename)
+        return load_CIFAR10_cache(filename)
     xs = []
     ys = []
     for b in range(1,6):
@@ -41,15 +135,107 @@ def load_CIFAR10(ROOT):
     return Xtr, Ytr, Xte, Yte
 
 
+class LazyImageArray(object):
+    """
+    Array-like view over raw uint8 images of shape (N, H, W, C) that applies the
+    preprocessing from get_CIFAR10_data one minibatch at a time. Indexing casts
+    only the selected images to dtype, subtracts the mean image and transposes
+    them to channels-first (N, C, H, W) layout, so the full float dataset is
+    never materialized and the raw storage (e.g. a memory-mapped cache from
+    load_CIFAR10(..., mmap=True)) stays shared.
+
+    Supports len(), .shape, .dtype, np.asarray() and indexing with an integer,
+    a slice or an index array along the first axis, which is all that Solver
+    needs; extra indices after the first are applied to the preprocessed
+    batch. Pass flatten=True to expose each image as a row vector of shape
+    (N, C * H * W) instead.
+    """
+
+    def __init__(self, X, mean_image=None, dtype=np.float64,
+                 channels_first=True, flatten=False):
+        self.X = X
+        self.mean_image = mean_image
+        self.dtype = np.dtype(dtype)
+        self.channels_first = channels_first
+        self.flatten = flatten
+
+    @property
+    def shape(self):
+        N, H, W, C = self.X.shape
+        if self.flatten:
+            return (N, H * W * C)
+        if self.channels_first:
+            return (N, C, H, W)
+        return (N, H, W, C)
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    def __len__(self):
+        return self.X.shape[0]
+
+    def __getitem__(self, idx):
+        rest = ()
+        if isinstance(idx, tuple):
+            idx, rest = idx[0], idx[1:]
+        single = np.ndim(idx) == 0 and not isinstance(idx, slice)
+        if single:
+            idx = [idx]
+
+        batch = np.array(self.X[idx], dtype=self.dtype)
+        if self.mean_image is not None:
+            batch -= self.mean_image
+        if self.channels_first:
+            batch = np.ascontiguousarray(batch.transpose(0, 3, 1, 2))
+        if self.flatten:
+            batch = batch.reshape(batch.shape[0], -1)
+
+        if single:
+            batch = batch[0]
+        if rest:
+            batch = batch[(slice(None),) * (not single) + rest]
+        return batch
+
+    def __array__(self, dtype=None, copy=None):
+        batch = self[:]
+        if dtype is not None:
+            batch = batch.astype(dtype, copy=False)
+        return batch
+
+
 def get_CIFAR10_data(num_training=49000, num_validation=1000, num_test=1000,
-                     subtract_mean=True):
+                     subtract_mean=True, lazy=False):
     """
     Load the CIFAR-10 dataset from disk and perform preprocessing to prepare
     it for classifiers. These are the same steps as we used for the SVM, but
     condensed to a single function.
+
+    With lazy=True the images stay in the memory-mapped uint8 cache and the
+    X_* entries are LazyImageArray views that cast, subtract the mean and
+    transpose each minibatch as it is indexed, instead of float64 copies of
+    the whole dataset.
     """
     # Load the raw CIFAR-10 data
     cifar10_dir = 'cs231n/datasets/cifar-10-batches-py'
+    if lazy:
+        X_train, y_train, X_test, y_test = load_CIFAR10(cifar10_dir, mmap=True)
+        X_val = X_train[num_training:num_training + num_validation]
+        y_val = y_train[num_training:num_training + num_validation]
+        X_train = X_train[:num_training]
+        y_train = y_train[:num_training]
+        X_test = X_test[:num_test]
+        y_test = y_test[:num_test]
+
+        mean_image = None
+        if subtract_mean:
+            mean_image = np.mean(X_train, axis=0)
+        return {
+          'X_train': LazyImageArray(X_train, mean_image), 'y_train': y_train,
+          'X_val': LazyImageArray(X_val, mean_image), 'y_val': y_val,
+          'X_test': LazyImageArray(X_test, mean_image), 'y_test': y_test,
+        }
+
     X_train, y_train, X_test, y_test = load_CIFAR10(cifar10_dir)
 
     # Subsample the data
@@ -83,7 +269,175 @@ def get_CIFAR10_data(num_training=49000, num_validation=1000, num_test=1000,
     }
 
 
-def load_tiny_imagenet(path, dtype=np.float32, subtract_mean=True):
+def _read_tiny_imagenet_image(img_file):
+    """ read one TinyImageNet image as a (3, 64, 64) (or (1, 64, 64)) array """
+    img = imread(img_file)
+    if img.ndim == 2:
+        ## grayscale file
+        img.shape = (64, 64, 1)
+    return img.transpose(2, 0, 1)
+
+
+def _decode_tiny_imagenet_files(X, offset, img_files):
+    """ decode img_files into X[offset:offset + len(img_files)] """
+    for j, img_file in enumerate(img_files):
+        X[offset + j] = _read_tiny_imagenet_image(img_file)
+    return len(img_files)
+
+
+# Output array shared with the worker processes of load_tiny_imagenet; filled
+# in by _init_tiny_imagenet_worker when each worker starts.
+_tiny_imagenet_shared = {}
+
+def _init_tiny_imagenet_worker(buf, shape, dtype):
+    _tiny_imagenet_shared['X'] = shared_view(buf, shape, dtype)
+
+def _decode_tiny_imagenet_task(task):
+    offset, img_files = task
+    return _decode_tiny_imagenet_files(_tiny_imagenet_shared['X'], offset,
+                                       img_files)
+
+def _decode_tiny_imagenet_block(task):
+    img_files, dtype = task
+    X = np.zeros((len(img_files), 3, 64, 64), dtype=dtype)
+    _decode_tiny_imagenet_files(X, 0, img_files)
+    return X
+
+
+def _tiny_imagenet_wnids(path):
+    with open(os.path.join(path, 'wnids.txt'), 'r') as f:
+        return [x.strip() for x in f]
+
+def _tiny_imagenet_train_files(path, wnid):
+    # To figure out the filenames we need to open the boxes file
+    boxes_file = os.path.join(path, 'train', wnid, '%s_boxes.txt' % wnid)
+    with open(boxes_file, 'r') as f:
+        filenames = [x.split('\t')[0] for x in f]
+    return [os.path.join(path, 'train', wnid, 'images', img_file)
+            for img_file in filenames]
+
+
+def iter_tiny_imagenet(path, dtype=np.float32, num_workers=1):
+    """
+    Stream the TinyImageNet training set one synset at a time, so training can
+    start before all of the images have been decoded.
+
+    Inputs:
+    - path: String giving path to the directory to load.
+    - dtype: numpy datatype used to load the data.
+    - num_workers: Number of processes used to decode synsets ahead of the
+      consumer; with 1 the images are decoded in this process and None uses
+      one worker per CPU.
+
+    Yields tuples (X_block, y_block) in wnids.txt order, where X_block is a
+    (num_images, 3, 64, 64) array of images from a single synset and y_block is
+    the (num_images,) array of its integer label. The mean image is not
+    subtracted.
+    """
+    wnids = _tiny_imagenet_wnids(path)
+    tasks = [(_tiny_imagenet_train_files(path, wnid), dtype) for wnid in wnids]
+    if num_workers is None:
+        num_workers = multiprocessing.cpu_count()
+    if num_workers == 1:
+        for label, task in enumerate(tasks):
+            X_block = _decode_tiny_imagenet_block(task)
+            yield X_block, label * np.ones(X_block.shape[0], dtype=np.int64)
+        return
+
+    # Keep a bounded number of synsets in flight so that the decoded blocks
+    # waiting for the consumer don't pile up in memory.
+    pool = multiprocessing.Pool(num_workers)
+    try:
+        pending = collections.deque()
+        for label, task in enumerate(tasks):
+            pending.append((label, pool.apply_async(_decode_tiny_imagenet_block,
+                                                    (task,))))
+            last = label == len(tasks) - 1
+            while pending and (last or len(pending) == 2 * num_workers):
+                block_label, result = pending.popleft()
+                X_block = result.get()
+                yield X_block, block_label * np.ones(X_block.shape[0],
+                                                     dtype=np.int64)
+    finally:
+        pool.close()
+        pool.join()
+
+
+# Directory inside a TinyImageNet folder where load_tiny_imagenet(cache=True)
+# keeps the decoded arrays, and the arrays that are stored there.
+TINY_IMAGENET_CACHE_DIR = '.cache'
+_TINY_IMAGENET_ARRAYS = ('X_train', 'y_train', 'X_val', 'y_val', 'X_test',
+                         'y_test', 'mean_image')
+
+def _tiny_imagenet_fingerprint(path, cache_dir):
+    """
+    Fingerprint a dataset directory from the number, relative paths, sizes and
+    mtimes of its files (skipping cache_dir) without reading any image data.
+    """
+    sha = hashlib.sha1()
+    num_files = 0
+    for root, dirs, files in os.walk(path):
+        dirs[:] = sorted(d for d in dirs if os.path.join(root, d) != cache_dir)
+        for name in sorted(files):
+            filename = os.path.join(root, name)
+            st = os.stat(filename)
+            line = '%s\t%d\t%r\n' % (os.path.relpath(filename, path),
+                                     st.st_size, st.st_mtime)
+            sha.update(line.encode('utf-8'))
+            num_files += 1
+    return '%d-%s' % (num_files, sha.hexdigest())
+
+def _load_tiny_imagenet_cache(cache_dir, fingerprint, dtype):
+    """ memory-map the cached arrays, or return None if the cache is stale """
+    meta_file = os.path.join(cache_dir, 'meta.json')
+    if not os.path.isfile(meta_file):
+        return None
+    with open(meta_file, 'r') as f:
+        meta = json.load(f)
+    if (meta['fingerprint'] != fingerprint or
+            meta['dtype'] != np.dtype(dtype).str):
+        return None
+    data = {'class_names': meta['class_names']}
+    for name in _TINY_IMAGENET_ARRAYS:
+        data[name] = None
+        if name in meta['arrays']:
+            # Copy-on-write, so callers can still modify the arrays in place.
+            data[name] = np.load(os.path.join(cache_dir, name + '.npy'),
+                                 mmap_mode='c')
+    return data
+
+def _save_tiny_imagenet_cache(cache_dir, fingerprint, data):
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    # The metadata is written last, so a partially written cache is never used.
+    meta_file = os.path.join(cache_dir, 'meta.json')
+    if os.path.isfile(meta_file):
+        os.remove(meta_file)
+    # Each array is written under a temporary name and renamed into place, so
+    # processes that memory-mapped the old file keep reading it intact.
+    arrays = []
+    for name in _TINY_IMAGENET_ARRAYS:
+        if data[name] is not None:
+            filename = os.path.join(cache_dir, name + '.npy')
+            tmp_filename = '%s.%d.tmp' % (filename, os.getpid())
+            with open(tmp_filename, 'wb') as f:
+                np.save(f, data[name])
+            os.replace(tmp_filename, filename)
+            arrays.append(name)
+    meta = {
+      'fingerprint': fingerprint,
+      'dtype': data['X_train'].dtype.str,
+      'class_names': data['class_names'],
+      'arrays': arrays,
+    }
+    tmp_filename = '%s.%d.tmp' % (meta_file, os.getpid())
+    with open(tmp_filename, 'w') as f:
+        json.dump(meta, f)
+    os.replace(tmp_filename, meta_file)
+
+
+def load_tiny_imagenet(path, dtype=np.float32, subtract_mean=True,
+                       num_workers=1, cache=False):
     """
     Load TinyImageNet. Each of TinyImageNet-100-A, TinyImageNet-100-B, and
     TinyImageNet-200 have the same directory structure, so this can be used
@@ -93,6 +447,13 @@ def load_tiny_imagenet(path, dtype=np.float32, subtract_mean=True):
     - path: String giving path to the directory to load.
     - dtype: numpy datatype used to load the data.
     - subtract_mean: Whether to subtract the mean training image.
+    - num_workers: Number of processes used to decode the images. Each worker
+      decodes whole synsets (and chunks of the val / test images) straight
+      into a preallocated shared array; None uses one worker per CPU.
+    - cache: If True, keep the decoded images in TINY_IMAGENET_CACHE_DIR
+      inside path and memory-map them on later calls instead of decoding the
+      JPEGs again. The cache is rebuilt whenever the file count, sizes or
+      mtimes under path change, or when a different dtype is requested.
 
     Returns: A dictionary with the following entries:
     - class_names: A list where class_names[i] is a list of strings giving the
@@ -106,9 +467,29 @@ def load_tiny_imagenet(path, dtype=np.float32, subtract_mean=True):
       (such as in student code) then y_test will be None.
     - mean_image: (3, 64, 64) array giving mean training image
     """
+    data = None
+    if cache:
+        cache_dir = os.path.join(path, TINY_IMAGENET_CACHE_DIR)
+        fingerprint = _tiny_imagenet_fingerprint(path, cache_dir)
+        data = _load_tiny_imagenet_cache(cache_dir, fingerprint, dtype)
+    if data is None:
+        data = _decode_tiny_imagenet(path, dtype, num_workers)
+        if cache:
+            _save_tiny_imagenet_cache(cache_dir, fingerprint, data)
+
+    if subtract_mean:
+        mean_image = data['mean_image']
+        data['X_train'] -= mean_image[None]
+        data['X_val'] -= mean_image[None]
+        data['X_test'] -= mean_image[None]
+
+    return data
+
+
+def _decode_tiny_imagenet(path, dtype, num_workers):
+    """ decode all splits for load_tiny_imagenet; the mean is not subtracted """
     # First load wnids
-    with open(os.path.join(path, 'wnids.txt'), 'r') as f:
-        wnids = [x.strip() for x in f]
+    wnids = _tiny_imagenet_wnids(path)
 
     # Map wnids to integer labels
     wnid_to_label = {wnid: i for i, wnid in enumerate(wnids)}
@@ -120,65 +501,67 @@ def load_tiny_imagenet(path, dtype=np.float32, subtract_mean=True):
             wnid_to_words[wnid] = [w.strip() for w in words.split(',')]
     class_names = [wnid_to_words[wnid] for wnid in wnids]
 
-    # Next load training data.
-    X_train = []
-    y_train = []
-    for i, wnid in enumerate(wnids):
-        if (i + 1) % 20 == 0:
-            print('loading training data for synset %d / %d'
-                  % (i + 1, len(wnids)))
-        # To figure out the filenames we need to open the boxes file
-        boxes_file = os.path.join(path, 'train', wnid, '%s_boxes.txt' % wnid)
-        with open(boxes_file, 'r') as f:
-            filenames = [x.split('\t')[0] for x in f]
-        num_images = len(filenames)
-
-        X_train_block = np.zeros((num_images, 3, 64, 64), dtype=dtype)
-        y_train_block = wnid_to_label[wnid] * \
-                        np.ones(num_images, dtype=np.int64)
-        for j, img_file in enumerate(filenames):
-            img_file = os.path.join(path, 'train', wnid, 'images', img_file)
-            img = imread(img_file)
-            if img.ndim == 2:
-        ## grayscale file
-                img.shape = (64, 64, 1)
-            X_train_block[j] = img.transpose(2, 0, 1)
-        X_train.append(X_train_block)
-        y_train.append(y_train_block)
-
-    # We need to concatenate all training data
-    X_train = np.concatenate(X_train, axis=0)
-    y_train = np.concatenate(y_train, axis=0)
+    # Collect the filenames for all three splits up front so that every image
+    # can be decoded straight into its slot of a single preallocated array.
+    train_files = [_tiny_imagenet_train_files(path, wnid) for wnid in wnids]
+    num_images = [len(files) for files in train_files]
+    y_train = np.repeat(np.arange(len(wnids), dtype=np.int64), num_images)
+    num_train = y_train.shape[0]
 
     # Next load validation data
     with open(os.path.join(path, 'val', 'val_annotations.txt'), 'r') as f:
-        img_files = []
+        val_files = []
         val_wnids = []
         for line in f:
             img_file, wnid = line.split('\t')[:2]
-            img_files.append(img_file)
+            val_files.append(os.path.join(path, 'val', 'images', img_file))
             val_wnids.append(wnid)
-        num_val = len(img_files)
-        y_val = np.array([wnid_to_label[wnid] for wnid in val_wnids])
-        X_val = np.zeros((num_val, 3, 64, 64), dtype=dtype)
-        for i, img_file in enumerate(img_files):
-            img_file = os.path.join(path, 'val', 'images', img_file)
-            img = imread(img_file)
-            if img.ndim == 2:
-                img.shape = (64, 64, 1)
-            X_val[i] = img.transpose(2, 0, 1)
-
-    # Next load test images
+    y_val = np.array([wnid_to_label[wnid] for wnid in val_wnids])
+    num_val = len(val_files)
+
     # Students won't have test labels, so we need to iterate over files in the
     # images directory.
     img_files = os.listdir(os.path.join(path, 'test', 'images'))
-    X_test = np.zeros((len(img_files), 3, 64, 64), dtype=dtype)
-    for i, img_file in enumerate(img_files):
-        img_file = os.path.join(path, 'test', 'images', img_file)
-        img = imread(img_file)
-        if img.ndim == 2:
-            img.shape = (64, 64, 1)
-        X_test[i] = img.transpose(2, 0, 1)
+    test_files = [os.path.join(path, 'test', 'images', img_file)
+                  for img_file in img_files]
+
+    # One task per training synset, plus fixed-size chunks of val / test.
+    tasks = []
+    offset = 0
+    for files in train_files:
+        tasks.append((offset, files))
+        offset += len(files)
+    chunk = 500
+    for files in (val_files, test_files):
+        for start in range(0, len(files), chunk):
+            tasks.append((offset + start, files[start:start + chunk]))
+        offset += len(files)
+
+    shape = (offset, 3, 64, 64)
+    if num_workers == 1:
+        X = np.zeros(shape, dtype=dtype)
+        decoded = (_decode_tiny_imagenet_files(X, *task) for task in tasks)
+    else:
+        if num_workers is None:
+            num_workers = multiprocessing.cpu_count()
+        buf, X = shared_array(shape, dtype)
+        pool = multiprocessing.Pool(num_workers, _init_tiny_imagenet_worker,
+                                    (buf, shape, dtype))
+        decoded = pool.imap_unordered(_decode_tiny_imagenet_task, tasks)
+    try:
+        num_decoded = 0
+        for count in decoded:
+            num_decoded += count
+            if num_decoded // 10000 != (num_decoded - count) // 10000:
+                print('loaded %d / %d images' % (num_decoded, offset))
+    finally:
+        if num_workers != 1:
+            pool.close()
+            pool.join()
+
+    X_train = X[:num_train]
+    X_val = X[num_train:num_train + num_val]
+    X_test = X[num_train + num_val:]
 
     y_test = None
     y_test_file = os.path.join(path, 'test', 'test_annotations.txt')
@@ -193,10 +576,6 @@ def load_tiny_imagenet(path, dtype=np.float32, subtract_mean=True):
         y_test = np.array(y_test)
 
     mean_image = X_train.mean(axis=0)
-    if subtract_mean:
-        X_train -= mean_image[None]
-        X_val -= mean_image[None]
-        X_test -= mean_image[None]
 
     return {
       'class_names': class_names,
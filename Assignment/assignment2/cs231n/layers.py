@@ -745,27 +745,34 @@ def svm_loss(x, y):
     return loss, dx
 
 
-def softmax_loss(x, y):
+def softmax_loss(x, y, out=None):
     """
     Computes the loss and gradient for softmax classification.
 
+    The scores are shifted by their row maximum for numerical stability and
+    exponentiated once, in place in the gradient array; the loss only needs
+    the log of the row sums and the shifted scores of the correct classes.
+
     Inputs:
     - x: Input data, of shape (N, C) where x[i, j] is the score for the jth
       class for the ith input.
     - y: Vector of labels, of shape (N,) where y[i] is the label for x[i] and
       0 <= y[i] < C
+    - out: Optional array of shape (N, C) in which to write dx, such as a
+      buffer reused across calls or x itself when x is not needed afterwards.
 
     Returns a tuple of:
     - loss: Scalar giving the loss
     - dx: Gradient of the loss with respect to x
     """
-    shifted_logits = x - np.max(x, axis=1, keepdims=True)
-    Z = np.sum(np.exp(shifted_logits), axis=1, keepdims=True)
-    log_probs = shifted_logits - np.log(Z)
-    probs = np.exp(log_probs)
     N = x.shape[0]
-    loss = -np.sum(log_probs[np.arange(N), y]) / N
-    dx = probs.copy()
-    dx[np.arange(N), y] -= 1
-    dx /= N
+    rows = np.arange(N)
+    dx = np.subtract(x, np.max(x, axis=1, keepdims=True), out=out)
+    correct_logits = dx[rows, y]
+    np.exp(dx, out=dx)
+    Z = np.sum(dx, axis=1)
+    loss = (np.sum(np.log(Z)) - np.sum(correct_logits)) / N
+    Z *= N
+    dx /= Z[:, np.newaxis]
+    dx[rows, y] -= 1.0 / N
     return loss, dx
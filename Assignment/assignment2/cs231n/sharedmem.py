@@ -0,0 +1,38 @@
+from builtins import range
+import multiprocessing
+
+import numpy as np
+
+
+def shared_array(shape, dtype):
+    """
+    Allocate an uninitialized array backed by shared memory, which the worker
+    processes of a multiprocessing.Pool can read and write without copies.
+
+    Returns a tuple of:
+    - buf: The shared buffer; pass it with the shape and dtype to the
+      workers, which rebuild the array with shared_view.
+    - array: The array of the given shape and dtype over buf.
+    """
+    dtype = np.dtype(dtype)
+    buf = multiprocessing.RawArray('b', int(np.prod(shape)) * dtype.itemsize)
+    return buf, shared_view(buf, shape, dtype)
+
+
+def shared_view(buf, shape, dtype):
+    """
+    The array of the given shape and dtype over a buffer from shared_array.
+    """
+    return np.frombuffer(buf, dtype=dtype).reshape(shape)
+
+
+def shared_copy(X, block_rows=4096):
+    """
+    Copy X into shared memory with the same shape and dtype, block_rows rows
+    at a time, so that X can also be an array-like such as a memory map;
+    returns a tuple (buf, array) as for shared_array.
+    """
+    buf, shared = shared_array(X.shape, X.dtype)
+    for start in range(0, X.shape[0], block_rows):
+        shared[start:start + block_rows] = X[start:start + block_rows]
+    return buf, shared
@@ -9,6 +9,7 @@ import pickle as pickle
 import numpy as np
 
 from cs231n import optim
+from cs231n import batching
 
 
 class Solver(object):
@@ -102,6 +103,15 @@ class Solver(object):
           learning rate is multiplied by this value.
         - batch_size: Size of minibatches used to compute loss and gradient
           during training.
+        - batch_sampler: Decides which training examples go into each
+          minibatch; either the name of a sampler in batching.SAMPLERS or a
+          sampler object (see batching.py). Default is 'random', which samples
+          every minibatch independently with replacement; 'epoch' shuffles
+          once per epoch and visits every example exactly once.
+        - prefetch: If greater than zero, minibatches are gathered on a
+          background thread that keeps this many batches ready ahead of the
+          training loop. Default is 0, which gathers each minibatch right
+          before it is used.
         - num_epochs: The number of epochs to run for during training.
         - print_every: Integer; training losses will be printed every
           print_every iterations.
@@ -125,6 +135,8 @@ class Solver(object):
         self.optim_config = kwargs.pop('optim_config', {})
         self.lr_decay = kwargs.pop('lr_decay', 1.0)
         self.batch_size = kwargs.pop('batch_size', 100)
+        self.batch_sampler = kwargs.pop('batch_sampler', 'random')
+        self.prefetch = kwargs.pop('prefetch', 0)
         self.num_epochs = kwargs.pop('num_epochs', 10)
         self.num_train_samples = kwargs.pop('num_train_samples', 1000)
         self.num_val_samples = kwargs.pop('num_val_samples', None)
@@ -144,6 +156,15 @@ class Solver(object):
             raise ValueError('Invalid update_rule "%s"' % self.update_rule)
         self.update_rule = getattr(optim, self.update_rule)
 
+        # Same for the batch sampler
+        if isinstance(self.batch_sampler, str):
+            if self.batch_sampler not in batching.SAMPLERS:
+                raise ValueError('Invalid batch_sampler "%s"'
+                                 % self.batch_sampler)
+            sampler_class = batching.SAMPLERS[self.batch_sampler]
+            self.batch_sampler = sampler_class(self.X_train.shape[0],
+                                               self.batch_size)
+
         self._reset()
 
 
@@ -159,6 +180,7 @@ class Solver(object):
         self.loss_history = []
         self.train_acc_history = []
         self.val_acc_history = []
+        self._batches = None
 
         # Make a deep copy of the optim_config for each parameter
         self.optim_configs = {}
@@ -173,10 +195,9 @@ class Solver(object):
         be called manually.
         """
         # Make a minibatch of training data
-        num_train = self.X_train.shape[0]
-        batch_mask = np.random.choice(num_train, self.batch_size)
-        X_batch = self.X_train[batch_mask]
-        y_batch = self.y_train[batch_mask]
+        if self._batches is None:
+            self._batches = self._make_batches()
+        X_batch, y_batch = next(self._batches)
 
         # Compute loss and gradient
         loss, grads = self.model.loss(X_batch, y_batch)
@@ -191,6 +212,24 @@ class Solver(object):
             self.optim_configs[p] = next_config
 
 
+    def _make_batches(self):
+        """
+        Return an iterator over (X_batch, y_batch) minibatches drawn by the
+        batch sampler, gathered on a background thread if prefetch is set.
+        """
+        if self.prefetch > 0:
+            return batching.BatchPrefetcher(self.X_train, self.y_train,
+                                            self.batch_sampler, self.prefetch)
+        return batching.iterate_minibatches(self.X_train, self.y_train,
+                                            self.batch_sampler)
+
+
+    def _close_batches(self):
+        if isinstance(self._batches, batching.BatchPrefetcher):
+            self._batches.close()
+        self._batches = None
+
+
     def _save_checkpoint(self):
         if self.checkpoint_name is None: return
         checkpoint = {
@@ -262,45 +301,51 @@ class Solver(object):
         iterations_per_epoch = max(num_train // self.batch_size, 1)
         num_iterations = self.num_epochs * iterations_per_epoch
 
-        for t in range(num_iterations):
-            self._step()
-
-            # Maybe print training loss
-            if self.verbose and t % self.print_every == 0:
-                print('(Iteration %d / %d) loss: %f' % (
-                       t + 1, num_iterations, self.loss_history[-1]))
-
-            # At the end of every epoch, increment the epoch counter and decay
-            # the learning rate.
-            epoch_end = (t + 1) % iterations_per_epoch == 0
-            if epoch_end:
-                self.epoch += 1
-                for k in self.optim_configs:
-                    self.optim_configs[k]['learning_rate'] *= self.lr_decay
-
-            # Check train and val accuracy on the first iteration, the last
-            # iteration, and at the end of each epoch.
-            first_it = (t == 0)
-            last_it = (t == num_iterations - 1)
-            if first_it or last_it or epoch_end:
-                train_acc = self.check_accuracy(self.X_train, self.y_train,
-                    num_samples=self.num_train_samples)
-                val_acc = self.check_accuracy(self.X_val, self.y_val,
-                    num_samples=self.num_val_samples)
-                self.train_acc_history.append(train_acc)
-                self.val_acc_history.append(val_acc)
-                self._save_checkpoint()
-
-                if self.verbose:
-                    print('(Epoch %d / %d) train acc: %f; val_acc: %f' % (
-                           self.epoch, self.num_epochs, train_acc, val_acc))
-
-                # Keep track of the best model
-                if val_acc > self.best_val_acc:
-                    self.best_val_acc = val_acc
-                    self.best_params = {}
-                    for k, v in self.model.params.items():
-                        self.best_params[k] = v.copy()
+        try:
+            for t in range(num_iterations):
+                self._step()
+
+                # Maybe print training loss
+                if self.verbose and t % self.print_every == 0:
+                    print('(Iteration %d / %d) loss: %f' % (
+                           t + 1, num_iterations, self.loss_history[-1]))
+
+                # At the end of every epoch, increment the epoch counter and
+                # decay the learning rate.
+                epoch_end = (t + 1) % iterations_per_epoch == 0
+                if epoch_end:
+                    self.epoch += 1
+                    for k in self.optim_configs:
+                        self.optim_configs[k]['learning_rate'] *= self.lr_decay
+
+                # Check train and val accuracy on the first iteration, the last
+                # iteration, and at the end of each epoch.
+                first_it = (t == 0)
+                last_it = (t == num_iterations - 1)
+                if first_it or last_it or epoch_end:
+                    train_acc = self.check_accuracy(self.X_train, self.y_train,
+                        num_samples=self.num_train_samples)
+                    val_acc = self.check_accuracy(self.X_val, self.y_val,
+                        num_samples=self.num_val_samples)
+                    self.train_acc_history.append(train_acc)
+                    self.val_acc_history.append(val_acc)
+                    self._save_checkpoint()
+
+                    if self.verbose:
+                        print('(Epoch %d / %d) train acc: %f; val_acc: %f'
+                              % (self.epoch, self.num_epochs, train_acc,
+                                 val_acc))
+
+                    # Keep track of the best model
+                    if val_acc > self.best_val_acc:
+                        self.best_val_acc = val_acc
+                        self.best_params = {}
+                        for k, v in self.model.params.items():
+                            self.best_params[k] = v.copy()
+        finally:
+            # Stop the prefetching thread, if there is one, even if
+            # training was interrupted
+            self._close_batches()
 
         # At the end of training swap the best params into the model
         self.model.params = self.best_params
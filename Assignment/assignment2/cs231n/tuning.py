@@ -0,0 +1,322 @@
+from __future__ import print_function, division
+from builtins import range
+from builtins import object
+import json
+import multiprocessing
+import os
+import time
+
+import numpy as np
+from six.moves import queue
+
+from cs231n.sharedmem import shared_array, shared_view
+from cs231n.solver import Solver
+
+
+def search(trial, data, param_space, num_trials, max_budget,
+           schedule='random', min_budget=None, eta=3, num_workers=None,
+           log_file=None, seed=0, verbose=False):
+    """
+    Search for good hyperparameters by training many trials on a pool of
+    worker processes.
+
+    The arrays of data are copied once into shared memory that every worker
+    reads, and each trial is a set of hyperparameters drawn from param_space.
+    With schedule='random' every trial is trained for max_budget. With
+    schedule='halving' trials are trained with asynchronous successive
+    halving (ASHA): they all start with min_budget, and whenever a worker is
+    free the best 1/eta of the trials that reached a budget, by score, are
+    trained on to eta times that budget (up to max_budget), picking up from
+    where they stopped. The other trials are never trained further, so
+    hopeless hyperparameters only cost min_budget each.
+
+    Every finished run is appended to log_file as one line of JSON. Calling
+    search again with the same log_file resumes the search: the runs in the
+    log are not repeated, though trials promoted after a restart are trained
+    again from scratch as their models are not logged.
+
+    Inputs:
+    - trial: A picklable callable trial(params, data, budget, state) that
+      trains a model with the hyperparameters in the dict params for budget
+      more units (iterations or epochs, say) and returns a tuple (score,
+      state), where score is the validation accuracy and state the trained
+      model; state is None for a new model. See SolverTrial.
+    - data: A dictionary of numpy arrays passed to every trial, such as the
+      'X_train', 'y_train', 'X_val' and 'y_val' of a Solver.
+    - param_space: A dictionary mapping each hyperparameter name to a list of
+      values, one of which is picked uniformly at random, or to an object
+      with a sample(rng) method such as LogUniform.
+    - num_trials: Number of hyperparameter settings to try.
+    - max_budget: Budget of a fully trained trial.
+    - schedule: 'random' or 'halving'.
+    - min_budget: First budget of the 'halving' schedule; defaults to
+      max_budget / eta ** 3.
+    - eta: Fraction of the trials promoted to the next budget, and the factor
+      by which the budget grows.
+    - num_workers: Number of processes; None uses one per CPU.
+    - log_file: Path of the JSON lines log, or None for no log.
+    - seed: Seed of the random hyperparameters; trials also seed np.random
+      with it and their trial number.
+    - verbose: If true, print every finished run.
+
+    Returns a tuple of:
+    - results: A list with a dictionary for each trial that was run,
+      describing its last run: 'trial' (its number), 'params', 'budget',
+      'score' and 'seconds'. Trials trained with larger budgets come first,
+      and equal budgets are ordered by decreasing score.
+    - best: The state returned for the first trial in results, or None if
+      that run was read from the log.
+    """
+    if schedule == 'random':
+        budgets = [max_budget]
+    elif schedule == 'halving':
+        if min_budget is None:
+            min_budget = max(1, int(max_budget // eta ** 3))
+        budgets = []
+        budget = min_budget
+        while budget < max_budget:
+            budgets.append(budget)
+            budget *= eta
+        budgets.append(max_budget)
+    else:
+        raise ValueError('Invalid schedule "%s"' % schedule)
+    if num_workers is None:
+        num_workers = multiprocessing.cpu_count()
+
+    rng = np.random.RandomState(seed)
+    trial_params = [_sample_params(param_space, rng)
+                    for i in range(num_trials)]
+    # scores[k] maps the trials that finished budget k to their scores, and
+    # promoted[k] holds the ones that were sent on to budget k + 1
+    scores = [{} for budget in budgets]
+    promoted = [set() for budget in budgets]
+    results = {}
+    if log_file is not None and os.path.exists(log_file):
+        for record in _read_search_log(log_file):
+            rung = record['rung']
+            if rung >= len(budgets) or record['budget'] != budgets[rung]:
+                raise ValueError('Log "%s" was written with other budgets'
+                                 % log_file)
+            trial_id = record['trial']
+            while trial_id >= len(trial_params):
+                trial_params.append(None)
+            trial_params[trial_id] = record['params']
+            scores[rung][trial_id] = record['score']
+            if rung > 0:
+                promoted[rung - 1].add(trial_id)
+            if results.get(trial_id, {'rung': -1})['rung'] < rung:
+                results[trial_id] = record
+    fresh = [i for i in range(num_trials) if i not in scores[0]]
+    fresh.reverse()
+    states = {}
+
+    def next_task():
+        # promote from the highest budget first, then start new trials
+        for rung in range(len(budgets) - 2, -1, -1):
+            rung_scores = scores[rung]
+            num_top = len(rung_scores) // eta
+            top = sorted(rung_scores, key=lambda i: (-rung_scores[i], i))
+            for trial_id in top[:num_top]:
+                if trial_id not in promoted[rung]:
+                    promoted[rung].add(trial_id)
+                    state, done = states.pop(trial_id, (None, 0))
+                    return (trial_id, rung + 1, trial_params[trial_id],
+                            budgets[rung + 1] - done, state, seed)
+        if fresh:
+            trial_id = fresh.pop()
+            return trial_id, 0, trial_params[trial_id], budgets[0], None, seed
+        return None
+
+    buffers = {}
+    for name, value in data.items():
+        value = np.asarray(value)
+        buf, shared = shared_array(value.shape, value.dtype)
+        shared[...] = value
+        buffers[name] = (buf, value.shape, value.dtype)
+
+    best, best_key = None, None
+    log = open(log_file, 'a') if log_file is not None else None
+    pool = multiprocessing.Pool(num_workers, _init_search_worker,
+                                (buffers, trial))
+    done = queue.Queue()
+    try:
+        num_running = 0
+        while True:
+            while num_running < num_workers:
+                task = next_task()
+                if task is None:
+                    break
+                # errors the task cannot return itself, such as a result
+                # that does not pickle, come through error_callback
+                pool.apply_async(_run_search_task, (task,),
+                                 callback=done.put, error_callback=done.put)
+                num_running += 1
+            if num_running == 0:
+                break
+            result = done.get()
+            num_running -= 1
+            if isinstance(result, BaseException):
+                raise result
+            trial_id, rung, score, state, seconds = result
+            scores[rung][trial_id] = score
+            if rung < len(budgets) - 1:
+                states[trial_id] = (state, budgets[rung])
+            key = (budgets[rung], score, -trial_id)
+            if best_key is None or key > best_key:
+                best, best_key = state, key
+            record = {'trial': trial_id, 'rung': rung,
+                      'budget': budgets[rung],
+                      'params': trial_params[trial_id], 'score': score,
+                      'seconds': seconds}
+            results[trial_id] = record
+            if log is not None:
+                log.write(json.dumps(record, sort_keys=True) + '\n')
+                log.flush()
+            if verbose:
+                print('trial %d budget %s: score %f (%.1fs)'
+                      % (trial_id, budgets[rung], score, seconds))
+    finally:
+        pool.close()
+        pool.join()
+        if log is not None:
+            log.close()
+
+    results = sorted(results.values(),
+                     key=lambda r: (-r['budget'], -r['score'], r['trial']))
+    for record in results:
+        del record['rung']
+    if not results or best_key != (results[0]['budget'], results[0]['score'],
+                                   -results[0]['trial']):
+        best = None
+    return results, best
+
+
+class LogUniform(object):
+    """
+    A hyperparameter for search whose logarithm is uniform between those of
+    low and high, as suits learning rates and regularization strengths.
+    """
+
+    def __init__(self, low, high):
+        self.low = low
+        self.high = high
+
+    def sample(self, rng):
+        return float(np.exp(rng.uniform(np.log(self.low), np.log(self.high))))
+
+
+class SolverTrial(object):
+    """
+    Trial for search that trains a model with a Solver; budgets are numbers
+    of epochs and the score is the best validation accuracy of the Solver.
+
+    The params of a trial are split three ways: the names of Solver options
+    in SOLVER_PARAMS are passed to the Solver, those in OPTIM_PARAMS go into
+    its optim_config, and all others are passed to model_fn to build the
+    model. A trial that is trained on continues with the same Solver, from
+    the best parameters it had found.
+
+    Inputs:
+    - model_fn: A picklable callable, such as a model class or a
+      functools.partial of one, that returns a new model given keyword
+      arguments.
+    - solver_kwargs: Options for every Solver, such as update_rule or
+      optim_config; verbose defaults to False.
+    """
+
+    SOLVER_PARAMS = ('update_rule', 'lr_decay', 'batch_size', 'batch_sampler')
+    OPTIM_PARAMS = ('learning_rate', 'momentum', 'decay_rate', 'beta1',
+                    'beta2', 'epsilon')
+
+    def __init__(self, model_fn, **solver_kwargs):
+        self.model_fn = model_fn
+        self.solver_kwargs = solver_kwargs
+
+    def __call__(self, params, data, budget, state):
+        solver = state
+        if solver is None:
+            solver_kwargs = {'verbose': False}
+            solver_kwargs.update(self.solver_kwargs)
+            optim_config = dict(solver_kwargs.get('optim_config', {}))
+            model_kwargs = {}
+            for name, value in params.items():
+                if name in self.SOLVER_PARAMS:
+                    solver_kwargs[name] = value
+                elif name in self.OPTIM_PARAMS:
+                    optim_config[name] = value
+                else:
+                    model_kwargs[name] = value
+            solver_kwargs['optim_config'] = optim_config
+            solver = Solver(self.model_fn(**model_kwargs), data,
+                            num_epochs=budget, **solver_kwargs)
+        else:
+            solver.X_train, solver.y_train = data['X_train'], data['y_train']
+            solver.X_val, solver.y_val = data['X_val'], data['y_val']
+            # train() made best_params the model's params; copy the arrays,
+            # as the update rules change them in place and would overwrite
+            # the best parameters
+            solver.model.params = {k: v.copy()
+                                   for k, v in solver.model.params.items()}
+            solver.num_epochs = budget
+        solver.train()
+        # the data is in shared memory; do not send it back with the state
+        solver.X_train = solver.y_train = solver.X_val = solver.y_val = None
+        return solver.best_val_acc, solver
+
+
+def _sample_params(param_space, rng):
+    params = {}
+    for name in sorted(param_space):
+        space = param_space[name]
+        if hasattr(space, 'sample'):
+            value = space.sample(rng)
+        else:
+            value = space[rng.randint(len(space))]
+        if isinstance(value, np.generic):
+            # keep the params JSON serializable
+            value = value.item()
+        params[name] = value
+    return params
+
+
+def _read_search_log(log_file):
+    """
+    The records of a search log, skipping a last line cut off by a crash.
+    """
+    records = []
+    with open(log_file) as f:
+        for line in f:
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                pass
+    return records
+
+
+# Shared state of the worker processes used by search; filled in by
+# _init_search_worker when each worker starts.
+_search_shared = {}
+
+
+def _init_search_worker(buffers, trial):
+    data = {}
+    for name, (buf, shape, dtype) in buffers.items():
+        data[name] = shared_view(buf, shape, dtype)
+    _search_shared['data'] = data
+    _search_shared['trial'] = trial
+
+
+def _run_search_task(task):
+    """
+    Train one trial for one budget; returns the result for search, or the
+    exception the trial raised.
+    """
+    trial_id, rung, params, budget, state, seed = task
+    np.random.seed([seed, trial_id, rung])
+    start = time.time()
+    try:
+        score, state = _search_shared['trial'](params, _search_shared['data'],
+                                               budget, state)
+    except BaseException as e:
+        return e
+    return trial_id, rung, float(score), state, time.time() - start